@@ -6,6 +6,15 @@
 # ---------------------------------------------------------------------
 # These are the configs you will need to adjust based on your filtering
 # vpy script and your system.
+#
+# The dispatch server measures the actual CPU usage, VRAM usage and
+# loading time of the workers it has released, and adjusts itself as
+# the encoding goes. `necessary_cpu`, `required_vram` and
+# `released_reserve_time` below are only the starting values before
+# enough workers have been measured, but it's still better to set them
+# as close as possible. `necessary_cpu` is also kept as the lowest CPU
+# usage the dispatch server expects for each worker, since it can't
+# always measure the encoder started for a worker.
 # ---------------------------------------------------------------------
 # This `necessary_cpu` parameter denotes the expected amount of CPU
 # used for each worker. This is the percentage of the CPU used with
@@ -73,6 +82,12 @@ released_reserve_time = 10 * 1000000000
 # ---------------------------------------------------------------------
 # If you're not using a NVIDIA GPU, search for `nvml` in this script
 # and replace it with a monitoring tool for your GPU brand.
+#
+# If there are multiple GPUs on the system, the dispatch server tracks
+# the VRAM on every GPU, and releases each worker on the GPU with the
+# most free VRAM. The index of this GPU is returned to the worker, and
+# you should pass it to your filters in your filtering vpy script. Check
+# `Worker.py` for more details.
 # ---------------------------------------------------------------------
 # Set the port used by the dispatch server. You can set it to any port
 # of your preference, as long as you set it the same in `Server.py`,
@@ -84,11 +99,13 @@ port = 18861
 # is for the case you want to perform other task on the system while
 # the encoding is running. As an example, to only release a new worker
 # when CPU dips below 60, run `USAGE=60 python Dispatch-Server.py &`.
+# If this is not set, a new worker is released when there's enough free
+# CPU for the measured CPU usage of a worker.
 import os
 if "USAGE" in os.environ:
     usage = float(os.environ["USAGE"])
 else:
-    usage = 100 - necessary_cpu
+    usage = None
 # ---------------------------------------------------------------------
 
 # ---------------------------------------------------------------------
@@ -113,23 +130,185 @@ else:
 # SOFTWARE.
 # ---------------------------------------------------------------------
 
-from psutil import cpu_percent
-from pynvml import nvmlInit, nvmlDeviceGetHandleByIndex, nvmlDeviceGetMemoryInfo
+from collections import deque
+from psutil import AccessDenied, cpu_count, cpu_percent, NoSuchProcess, Process, process_iter
+from pynvml import nvmlInit, nvmlDeviceGetComputeRunningProcesses, nvmlDeviceGetCount, nvmlDeviceGetHandleByIndex, nvmlDeviceGetMemoryInfo
 from time import sleep, time_ns
-from threading import Lock
+from threading import Condition, get_ident, Lock, Thread
 from rpyc import Service, ThreadedServer
 
 nvmlInit()
-handle = nvmlDeviceGetHandleByIndex(0)
+handles = [nvmlDeviceGetHandleByIndex(device) for device in range(nvmlDeviceGetCount())]
+
+# CPU and VRAM are sampled in a background thread every `sample_interval`
+# seconds. CPU usage is averaged over the last `sample_window` samples,
+# and VRAM uses the latest sample. Workers waiting for release are woken
+# up after every sample to check again.
+sample_interval = 0.1
+sample_window = 5
+
+# Workers that send their PID are measured in the same thread until
+# they exit. The estimates for each worker are from the last
+# `calibration_window` measured workers, starting with `necessary_cpu`,
+# `required_vram` and `released_reserve_time` as if they were measured.
+# VRAM and loading time use the highest of these workers to stay on the
+# safe side, and CPU uses the average. The loading time is the time it
+# takes for a worker to reach 95% of its highest VRAM usage.
+# The CPU usage of a worker includes the processes it starts, and, on
+# Linux, the encoder reading from it, which av1an starts next to it.
+# It's averaged from after its loading time, and `necessary_cpu` is
+# kept as the lowest CPU estimate, since the encoder can't be found on
+# other systems.
+# The processes of each worker are looked up again every
+# `calibration_lookup` samples.
+calibration_window = 12
+calibration_lookup = 10
 
 class QueueService(Service):
     lock = Lock()
+    condition = Condition(lock)
     queue = []
+    # Each item in `released_reserve` is the time the reserve ends, the
+    # GPU the worker is released on, and the PID of the worker, which is
+    # `None` if the worker didn't send it.
     released_reserve = []
     last_contact_first_in_queue = time_ns()
+    cpu_samples = deque(maxlen=sample_window)
+    free_vram = [0] * len(handles)
+    workers = {}
+    measured_cpu = deque([necessary_cpu], maxlen=calibration_window)
+    measured_vram = deque([required_vram], maxlen=calibration_window)
+    measured_reserve_time = deque([released_reserve_time], maxlen=calibration_window)
+    # rpyc serves each connection in its own thread. `connections` is the
+    # connection of each thread, and `connection_tids` is the tids
+    # registered from each connection.
+    connections = {}
+    connection_tids = {}
+    reported = set()
+
+    # Errors from psutil or NVML, such as a GPU not supporting per process
+    # VRAM usage, are printed and the sampling continues. If the workers
+    # can't be measured, only the system-wide figures are sampled.
+    def sample(self):
+        cpu_percent(interval=None)
+        samples = 0
+        while True:
+            sleep(sample_interval)
+            try:
+                cpu = cpu_percent(interval=None)
+                free = [nvmlDeviceGetMemoryInfo(handle).free for handle in handles]
+
+                with self.lock:
+                    workers = list(self.workers.items())
+                if workers and samples % calibration_lookup == 0:
+                    try:
+                        self.lookup_processes(workers)
+                    except Exception as error:
+                        self.report(error)
+                samples += 1
+                worker_vram = {}
+                if workers:
+                    try:
+                        for handle in handles:
+                            for process in nvmlDeviceGetComputeRunningProcesses(handle):
+                                if process.usedGpuMemory is not None:
+                                    worker_vram[process.pid] = worker_vram.get(process.pid, 0) + process.usedGpuMemory
+                    except Exception as error:
+                        self.report(error)
+                        worker_vram = {}
+                worker_cpu = {}
+                for pid, worker in workers:
+                    worker_cpu[pid] = 0
+                    for process_pid, process in list(worker["processes"].items()):
+                        try:
+                            worker_cpu[pid] += process.cpu_percent(interval=None) / cpu_count()
+                        except NoSuchProcess:
+                            del worker["processes"][process_pid]
+                        except AccessDenied as error:
+                            self.report(error)
+                            del worker["processes"][process_pid]
+                    if pid not in worker["processes"]:
+                        worker_cpu[pid] = None
+
+                with self.lock:
+                    self.cpu_samples.append(cpu)
+                    self.free_vram = free
+                    for pid, worker in workers:
+                        vram = [worker_vram[process_pid] for process_pid in worker["processes"] if process_pid in worker_vram]
+                        self.locked_measure_worker(pid, worker_cpu[pid], sum(vram) if vram else None)
+                    self.condition.notify_all()
+            except Exception as error:
+                self.report(error)
+
+    # The same error is only printed once.
+    def report(self, error):
+        message = f"{type(error).__name__}: {error}"
+        if message not in self.reported:
+            self.reported.add(message)
+            print(f"Sampling failed with {message}", flush=True)
+
+    # This adds the processes started by each worker, and the encoder
+    # reading from each worker, to `processes` of the worker.
+    def lookup_processes(self, workers):
+        children = {}
+        for process in process_iter(["ppid"]):
+            children.setdefault(process.info["ppid"], []).append(process.pid)
+        for pid, worker in workers:
+            roots = [pid]
+            if worker["encoder"] is None:
+                try:
+                    pipe = os.readlink(f"/proc/{pid}/fd/1")
+                    if pipe.startswith("pipe:"):
+                        for sibling in children.get(worker["processes"][pid].ppid(), []):
+                            try:
+                                if sibling != pid and os.readlink(f"/proc/{sibling}/fd/0") == pipe:
+                                    worker["encoder"] = sibling
+                            except OSError:
+                                pass
+                except (OSError, NoSuchProcess):
+                    pass
+            if worker["encoder"] is not None:
+                roots.append(worker["encoder"])
+            while roots:
+                process_pid = roots.pop()
+                roots += children.get(process_pid, [])
+                if process_pid not in worker["processes"]:
+                    try:
+                        process = Process(process_pid)
+                        process.cpu_percent(interval=None)
+                    except (NoSuchProcess, AccessDenied):
+                        continue
+                    worker["processes"][process_pid] = process
+
+    def locked_measure_worker(self, pid, cpu, vram):
+        worker = self.workers[pid]
+        if cpu is None:
+            del self.workers[pid]
+            # Workers that exit right after release have likely failed and
+            # are not counted.
+            if len(worker["cpu"]) >= sample_window:
+                if worker["vram"]:
+                    self.measured_vram.append(worker["vram"][-1][1])
+                    self.measured_reserve_time.append(next(time for time, vram in worker["vram"] if vram >= worker["vram"][-1][1] * 0.95) - worker["released"])
+                    loaded = worker["released"] + self.measured_reserve_time[-1]
+                else:
+                    loaded = worker["released"] + max(self.measured_reserve_time)
+                if cpu := [cpu for time, cpu in worker["cpu"] if time >= loaded]:
+                    self.measured_cpu.append(sum(cpu) / len(cpu))
+            return
+
+        worker["cpu"].append((time_ns(), cpu))
+        worker["current_cpu"] = cpu
+        if vram is not None:
+            worker["current_vram"] = vram
+            if not worker["vram"] or vram > worker["vram"][-1][1]:
+                worker["vram"].append((time_ns(), vram))
+
+    def locked_estimates(self):
+        return max(sum(self.measured_cpu) / len(self.measured_cpu), necessary_cpu), max(self.measured_vram), max(self.measured_reserve_time)
 
     def locked_clean_reserve(self):
-        self.released_reserve = [item for item in self.released_reserve if item > time_ns()]
+        self.released_reserve = [item for item in self.released_reserve if item[0] > time_ns()]
 
     def locked_reset_first_in_queue(self):
         self.last_contact_first_in_queue = time_ns()
@@ -142,37 +321,102 @@ class QueueService(Service):
                 self.queue.pop(0)
                 self.locked_reset_first_in_queue()
 
+    def on_connect(self, conn):
+        with self.lock:
+            self.connections[get_ident()] = conn
+            self.connection_tids[conn] = []
+
+    # Workers that disconnect while waiting are removed from the queue.
+    def on_disconnect(self, conn):
+        with self.lock:
+            for ident in [ident for ident, connection in self.connections.items() if connection is conn]:
+                del self.connections[ident]
+            for tid in self.connection_tids.pop(conn, []):
+                if tid in self.queue:
+                    if self.queue[0] == tid:
+                        self.locked_reset_first_in_queue()
+                    self.queue.remove(tid)
+            self.condition.notify_all()
+
     def exposed_register(self):
         with self.lock:
             sleep(0.001)
             tid = time_ns()
             self.queue.append(tid)
+            if (conn := self.connections.get(get_ident())) is not None:
+                self.connection_tids[conn].append(tid)
 
             self.locked_check_first_in_queue(tid)
 
             return tid
 
-    def exposed_request_release(self, tid):
-        with self.lock:
-            self.locked_check_first_in_queue(tid)
+    # This returns the GPU the worker is released on, or `None` if the
+    # worker is not released.
+    def locked_request_release(self, tid, pid=None):
+        self.locked_check_first_in_queue(tid)
 
-            if self.queue[0] == tid or tid not in self.queue:
-                self.locked_clean_reserve()
+        if self.queue[0] == tid or tid not in self.queue:
+            self.locked_clean_reserve()
 
-                free = nvmlDeviceGetMemoryInfo(handle).free - required_vram * len(self.released_reserve)
-                cpu = cpu_percent(interval=0.1) + necessary_cpu * len(self.released_reserve)
-                if free >= required_vram and cpu < usage:
-                    self.queue.pop(0)
-                    self.released_reserve.append(time_ns() + released_reserve_time)
+            # Workers still loading are reserved for the part of the
+            # estimates they are not yet using.
+            cpu_estimate, vram_estimate, reserve_time_estimate = self.locked_estimates()
+            reserved_cpu = 0
+            reserved_vram = [0] * len(handles)
+            for _, device, reserve_pid in self.released_reserve:
+                if reserve_pid is None:
+                    reserved_cpu += cpu_estimate
+                    reserved_vram[device] += vram_estimate
+                elif reserve_pid in self.workers:
+                    reserved_cpu += max(cpu_estimate - self.workers[reserve_pid]["current_cpu"], 0)
+                    reserved_vram[device] += max(vram_estimate - self.workers[reserve_pid]["current_vram"], 0)
 
-                    self.locked_reset_first_in_queue()
+            free = [self.free_vram[device] - reserved_vram[device] for device in range(len(handles))]
+            device = max(range(len(handles)), key=lambda device: free[device])
+            cpu = sum(self.cpu_samples) / len(self.cpu_samples) + reserved_cpu
+            if free[device] >= vram_estimate and cpu < (usage if usage is not None else 100 - cpu_estimate):
+                self.queue.pop(0)
+                if pid is not None:
+                    try:
+                        process = Process(pid)
+                        process.cpu_percent(interval=None)
+                    except (NoSuchProcess, AccessDenied):
+                        pid = None
+                    else:
+                        self.workers[pid] = {"processes": {pid: process}, "encoder": None, "released": time_ns(), "cpu": [], "vram": [],
+                                             "current_cpu": 0, "current_vram": 0}
+                self.released_reserve.append((time_ns() + reserve_time_estimate, device, pid))
+
+                self.locked_reset_first_in_queue()
+                self.condition.notify_all()
+
+                return device
+                
+        return None
+
+    # Workers from before `wait_for_release` poll this instead.
+    def exposed_request_release(self, tid):
+        with self.lock:
+            self.condition.wait_for(lambda: self.cpu_samples)
+            return self.locked_request_release(tid) is not None
 
-                    return True
-                    
-            return False
+    # rpyc doesn't read from the connection while this is waiting, so the
+    # connection is polled here to notice a worker that has disconnected.
+    # Otherwise the waiting would keep the worker first in queue forever.
+    def exposed_wait_for_release(self, tid, pid=None):
+        conn = self.connections.get(get_ident())
+        while True:
+            with self.lock:
+                if self.cpu_samples and (device := self.locked_request_release(tid, pid)) is not None:
+                    return device
+                self.condition.wait()
+            if conn is not None:
+                conn.poll()
 
     def exposed_shutdown(self):
         server.close()
 
-server = ThreadedServer(QueueService(), port=port)
+service = QueueService()
+Thread(target=service.sample, daemon=True).start()
+server = ThreadedServer(service, port=port)
 server.start()
@@ -35,12 +35,17 @@ port = 18861
 # optimal place to paste this is after you've imported vapoursynth and
 # all the vsfunc's, and after you've loaded the source file, but before
 # any filtering using VRAM is created / performed.
+#
+# If there are multiple GPUs on the system, `device` is the index of
+# the GPU this worker is released on. Pass it to every filter using
+# VRAM in your filtering vpy script, for example `device_id=device`.
+# The index is in the same order as `nvidia-smi`. Set environment
+# variable `CUDA_DEVICE_ORDER=PCI_BUS_ID` so that CUDA uses this order.
 # ---------------------------------------------------------------------
 
+import os
 import rpyc
-import time
 
-c = rpyc.connect("localhost", port)
+c = rpyc.connect("localhost", port, config={"sync_request_timeout": None})
 tid = c.root.register()
-while not c.root.request_release(tid):
-    time.sleep(0.1)
+device = c.root.wait_for_release(tid, os.getpid())
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+# Progression Boost
+# Copyright (c) Akatsumekusa and contributors
+
+
+# ---------------------------------------------------------------------
+# This benchmarks the CPU side hot paths of Progression Boost with
+# synthetic data, so that regressions and speed-ups can be measured on
+# any machine without a source video, a GPU or av1an.
+#
+# The functions are taken from `Progression-Boost.py` itself together
+# with its config, so whatever is set in the config, such as
+# `metric_model` or `scene_detection_target_split`, is what's being
+# benchmarked. Run it with `python Progression-Boost-Benchmark.py`, or
+# `python Progression-Boost-Benchmark.py --help` for all options.
+#
+# With `--check`, instead of benchmarking, this checks that
+# `scene_detection_split_scene` creates the same scenes as the argsort
+# based splitter it replaced, and that `metric_scene_crf` picks the same
+# `--crf` as the 0.05 step scan it replaced.
+# ---------------------------------------------------------------------
+
+
+import argparse
+import ast
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from functools import partial, wraps
+import json
+import math
+import numpy as np
+from numpy.random import default_rng
+import os
+from pathlib import Path
+import platform
+from scipy.optimize import Bounds, minimize
+from scipy.stats import median_abs_deviation
+import sys
+import threading
+from time import perf_counter
+import tracemalloc
+
+benchmark_cases = {
+    "short": (1000, 100),
+    "episode": (34000, 600),
+    "film": (200000, 5000)
+}
+
+parser = argparse.ArgumentParser(prog="Progression Boost Benchmark")
+parser.add_argument("--script", type=Path, default=Path(__file__).with_name("Progression-Boost.py"), help="Progression Boost script to benchmark (Default: `Progression-Boost.py` next to this file)")
+parser.add_argument("--case", action="append", choices=list(benchmark_cases), help="Size of the synthetic data, in frames and scenes: short 1k frames and 100 scenes, episode 34k frames and 600 scenes, film 200k frames and 5000 scenes. Can be specified multiple times (Default: all)")
+parser.add_argument("--benchmark", action="append", choices=["split", "pick", "model", "crf", "read"], help="Benchmark to run. Can be specified multiple times (Default: all)")
+parser.add_argument("--repeat", type=int, default=3, help="Number of times each benchmark is run. The fastest run is reported (Default: 3)")
+parser.add_argument("--output", type=Path, help="Write the results as JSON to this file for comparing between runs")
+parser.add_argument("--check", action="store_true", help="Instead of benchmarking, check that `scene_detection_split_scene` creates the same scenes as the argsort based splitter it replaced on random and tie-heavy diffs, and that `metric_scene_crf` picks the same `--crf` as the 0.05 step scan it replaced")
+args = parser.parse_args()
+benchmark_cases = {case: benchmark_cases[case] for case in (args.case if args.case else benchmark_cases)}
+benchmark_benchmarks = args.benchmark if args.benchmark else ["split", "pick", "model", "crf", "read"]
+
+if platform.system() == "Windows":
+    os.system("")
+
+
+# Loading
+# Functions and config are picked out of the script by name, including the functions defined inside `progression_boost_run`.
+# Assignments are picked from the config and from the top level of `progression_boost_run`.
+loading_names = {
+    "testing_crfs", "final_min_crf", "final_max_crf",
+    "scene_detection_extra_split", "scene_detection_min_scene_len", "scene_detection_target_split",
+    "scene_detection_build_argmax", "scene_detection_argmax", "scene_detection_split_scene",
+    "metric_highest_diff_frames", "metric_highest_diff_min_separation",
+    "metric_upper_diff_bracket_frames", "metric_lower_diff_bracket_frames", "metric_lower_diff_bracket_min_separation", "metric_upper_diff_bracket_fallback_frames",
+    "metric_first_frame", "metric_last_frame", "metric_pick_frames",
+    "metric_better_metric", "UnreliableModelError", "metric_model", "metric_target",
+    "metric_iterate_crfs", "metric_solve_crf", "metric_scene_model", "metric_scene_crf",
+    "metric_sequential_read_frames", "metric_stored_clip",
+    "profile_lane", "profile_begin", "profile_end", "profile_function", "profile_events", "profile_lanes", "profile_lock", "profile_start"
+}
+loading_tree = ast.parse(args.script.read_text(encoding="utf-8"), filename=str(args.script))
+loading_nodes = {}
+for node in ast.walk(loading_tree):
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in loading_names:
+        loading_nodes.setdefault(node.name, node)
+loading_run = next(node for node in loading_tree.body if isinstance(node, ast.FunctionDef) and node.name == "progression_boost_run")
+for node in loading_tree.body + loading_run.body:
+    if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and node.targets[0].id in loading_names:
+        loading_nodes[node.targets[0].id] = node
+assert not (loading_missing := loading_names - set(loading_nodes)), f"Unable to find {", ".join(sorted(loading_missing))} in `{args.script}`."
+
+boost = {
+    "Bounds": Bounds, "Callable": Callable, "math": math, "median_abs_deviation": median_abs_deviation,
+    "minimize": minimize, "np": np, "os": os, "partial": partial, "perf_counter": perf_counter, "threading": threading, "wraps": wraps,
+    "profile_enable": False,
+    "scene_detection_rjust": lambda frame: str(frame),
+    "metric_scene_frame_print": lambda scene, start_frame, end_frame: f"Scene {scene} Frame [{start_frame}:{end_frame}]"
+}
+for node in sorted(loading_nodes.values(), key=lambda node: node.lineno):
+    exec(compile(ast.Module(body=[node], type_ignores=[]), str(args.script), "exec"), boost)
+
+
+# Synthetic data
+# Diffs are mostly small with a scenecut every few dozens to a few hundreds frames, similar to the LumaDiff of an anime episode.
+def synthetic_diffs(frames):
+    rng = default_rng(frames)
+    luma_diffs = np.minimum(rng.exponential(0.02, size=frames), 0.99)
+    cuts = np.cumsum(rng.geometric(1 / 90, size=frames // 4 + 1))
+    cuts = cuts[cuts < frames]
+    # The scene detection diffs as computed before `scene_detection_split_scene`, with WWXD scenecuts and a few luma scenecuts.
+    diffs = luma_diffs.copy()
+    diffs[cuts] += np.where(rng.random(cuts.shape[0]) < 0.1, 2.0, 1.0)
+    diffs[0] = 1.0
+    return luma_diffs, diffs
+
+# Every scene has at least 3 frames for frame picking, and the rest of the frames are distributed randomly.
+def synthetic_scenes(frames, count):
+    rng = default_rng(count)
+    lengths = 3 + rng.multinomial(frames - 3 * count, rng.dirichlet(np.ones(count)))
+    start_frames = np.concatenate(([0], np.cumsum(lengths)))
+    return [{"start_frame": int(start_frames[i]), "end_frame": int(start_frames[i + 1])} for i in range(count)]
+
+# Quantisers follow a cubic curve decreasing in `--crf` for `np.greater` metrics such as SSIMU2, with noise and an occasional outlier.
+def synthetic_quantisers(count):
+    rng = default_rng(count)
+    crfs = boost["testing_crfs"]
+    top = rng.uniform(80, 92, size=(count, 1))
+    slope = rng.uniform(0.25, 0.7, size=(count, 1))
+    curve = rng.uniform(0, 0.004, size=(count, 1))
+    quantisers = top - slope * (crfs - crfs[0]) - curve * (crfs - crfs[0]) ** 2 + rng.normal(0, 0.4, size=(count, crfs.shape[0]))
+    outliers = rng.random((count, crfs.shape[0])) < 0.01
+    quantisers[outliers] += rng.normal(0, 6, size=np.count_nonzero(outliers))
+    if not boost["metric_better_metric"](1, 0):
+        quantisers = 100 - quantisers
+    return quantisers
+
+
+# Benchmarks
+# Each benchmark is a function taking the case and returning a function to be timed together with the number of items it processes.
+def benchmark_split(frames, count):
+    _, diffs = synthetic_diffs(frames)
+    def run():
+        boost["scene_detection_argmax_table"] = boost["scene_detection_build_argmax"](diffs)
+        return boost["scene_detection_split_scene"](diffs, 0, diffs.shape[0])
+    return run, frames, "frames"
+
+def benchmark_pick(frames, count):
+    boost["scene_detection_diffs"], _ = synthetic_diffs(frames)
+    scenes = synthetic_scenes(frames, count)
+    def run():
+        return boost["metric_pick_frames"](scenes)
+    return run, len(scenes), "scenes"
+
+# Scenes are fitted independently by `metric_model`, so at most `benchmark_model_scenes` scenes are fitted to keep the benchmark short.
+benchmark_model_scenes = 500
+def benchmark_model(frames, count):
+    count = min(count, benchmark_model_scenes)
+    quantisers = synthetic_quantisers(count)
+    boost["testing_encoded"] = np.ones((count, boost["testing_crfs"].shape[0]), dtype=bool)
+    scene = {"start_frame": 0, "end_frame": 0}
+    def run():
+        return [boost["metric_scene_model"](i, scene, quantisers[i], []) for i in range(count)]
+    return run, count, "scenes"
+
+# The models are fitted in the same way as Progression Boost. At most `benchmark_model_scenes` models are fitted, and they are reused for
+# the rest of the scenes.
+def benchmark_crf(frames, count):
+    quantisers = synthetic_quantisers(min(count, benchmark_model_scenes))
+    boost["testing_encoded"] = np.ones((quantisers.shape[0], boost["testing_crfs"].shape[0]), dtype=bool)
+    scene = {"start_frame": 0, "end_frame": 0}
+    models = [boost["metric_scene_model"](i, scene, quantisers[i], [])[0] for i in range(quantisers.shape[0])]
+    def run():
+        return [boost["metric_scene_crf"](i, scene, models[i % len(models)], []) for i in range(count)]
+    return run, count, "scenes"
+
+# This reads frames from two `std.BlankClip`s in ascending order and serves them from memory through `metric_stored_clip` while the next
+# chunk is being read, the same as `metric_sequential_read`, with `std.PlaneStats` in place of the GPU metric. This is skipped if
+# VapourSynth is not installed.
+def benchmark_read(frames, count):
+    try:
+        import vapoursynth as vs
+        from vapoursynth import core
+    except ImportError:
+        return None
+    boost["core"] = core
+    reference = core.std.BlankClip(format=vs.YUV420P10, width=1920, height=1080, length=frames, color=[512, 512, 512])
+    distorted = core.std.BlankClip(reference, color=[520, 512, 512])
+    picked = np.sort(default_rng(frames).choice(frames, size=min(frames, count * 16), replace=False))
+    chunk_frames = boost["metric_sequential_read_frames"]
+    def run():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            read_chunk = lambda chunk_start: [executor.submit(lambda clip, chunk: [clip.get_frame(int(frame)) for frame in chunk], clip, picked[chunk_start:chunk_start + chunk_frames])
+                                              for clip in [reference, distorted]]
+            chunk_read = read_chunk(0)
+            for chunk_start in range(0, picked.shape[0], chunk_frames):
+                chunk_reference, chunk_distorted = [future.result() for future in chunk_read]
+                if chunk_start + chunk_frames < picked.shape[0]:
+                    chunk_read = read_chunk(chunk_start + chunk_frames)
+                clip = core.std.PlaneStats(boost["metric_stored_clip"](reference, chunk_reference), boost["metric_stored_clip"](distorted, chunk_distorted))
+                for frame in clip.frames(backlog=48):
+                    frame.props["PlaneStatsDiff"]
+    return run, picked.shape[0], "frames"
+
+benchmark_functions = {
+    "split": benchmark_split,
+    "pick": benchmark_pick,
+    "model": benchmark_model,
+    "crf": benchmark_crf,
+    "read": benchmark_read
+}
+
+# Check
+# This is the argsort based splitter `scene_detection_split_scene` replaced, with the config passed in. In the original, `great_diffs` was
+# sorted with the default unstable argsort, so frames with the same diff above 1.0 had no defined order, while `diffs` was sorted with a
+# stable argsort and reversed, so frames with the same diff went to the later frame first. Both sorts are stable here, and ties go to the
+# later frame, which is the rule `scene_detection_argmax` follows.
+def check_split_scene(great_diffs, diffs, start_frame, end_frame, extra_split, min_scene_len, target_split):
+    if end_frame - start_frame <= target_split or \
+       end_frame - start_frame < 2 * min_scene_len:
+        return [start_frame]
+
+    split = lambda current_frame: check_split_scene(great_diffs, diffs, start_frame, current_frame, extra_split, min_scene_len, target_split) + \
+                                  check_split_scene(great_diffs, diffs, current_frame, end_frame, extra_split, min_scene_len, target_split)
+
+    great_diffs_sort = np.argsort(great_diffs, stable=True)[::-1]
+
+    if end_frame - start_frame <= 2 * target_split:
+        for current_frame in great_diffs_sort:
+            if great_diffs[current_frame] < 1.16:
+                break
+            if current_frame - start_frame >= min_scene_len and end_frame - current_frame >= min_scene_len and \
+               current_frame - start_frame <= target_split and end_frame - current_frame <= target_split:
+                return split(current_frame)
+
+    if end_frame - start_frame <= extra_split:
+        for current_frame in great_diffs_sort:
+            if great_diffs[current_frame] < 1.16:
+                break
+            if (current_frame - start_frame >= min_scene_len and end_frame - current_frame >= min_scene_len) and \
+               (current_frame - start_frame <= target_split or end_frame - current_frame <= target_split):
+                return split(current_frame)
+
+        for current_frame in great_diffs_sort:
+            if great_diffs[current_frame] < 1.16:
+                return [start_frame]
+            if current_frame - start_frame >= min_scene_len and end_frame - current_frame >= min_scene_len:
+                return split(current_frame)
+
+    else:
+        for current_frame in great_diffs_sort:
+            if great_diffs[current_frame] < 1.12:
+                break
+            if (current_frame - start_frame >= min_scene_len and end_frame - current_frame >= min_scene_len) and \
+               math.ceil((current_frame - start_frame) / extra_split) + math.ceil((end_frame - current_frame) / extra_split) <= \
+               math.ceil((end_frame - start_frame) / extra_split + 0.15):
+                return split(current_frame)
+
+        for current_frame in great_diffs_sort:
+            if great_diffs[current_frame] < 1.16:
+                break
+            if (current_frame - start_frame >= min_scene_len and end_frame - current_frame >= min_scene_len) and \
+               (current_frame - start_frame <= target_split or end_frame - current_frame <= target_split):
+                return split(current_frame)
+
+        for current_frame in great_diffs_sort:
+            if great_diffs[current_frame] < 1.16:
+                break
+            if current_frame - start_frame >= min_scene_len and end_frame - current_frame >= min_scene_len:
+                return split(current_frame)
+
+        diffs_sort = np.argsort(diffs, stable=True)[::-1]
+
+        for current_frame in diffs_sort:
+            if (current_frame - start_frame >= min_scene_len and end_frame - current_frame >= min_scene_len) and \
+               math.ceil((current_frame - start_frame) / extra_split) + math.ceil((end_frame - current_frame) / extra_split) <= \
+               math.ceil((end_frame - start_frame) / extra_split):
+                return split(current_frame)
+
+    assert False
+
+# `scene_detection_extra_split`, `scene_detection_min_scene_len` and `scene_detection_target_split` to check with, besides the config.
+check_split_settings = [(120, 6, 30), (48, 12, 40), (300, 24, 90), (60, 10, 60), (24, 12, 12)]
+check_split_arrays = 60
+
+# Half of the diffs are random with scenecuts, and half are drawn from a few values around the thresholds so that there are many ties.
+def check_split():
+    rng = default_rng(0)
+    settings = [(boost["scene_detection_extra_split"], boost["scene_detection_min_scene_len"], boost["scene_detection_target_split"])] + check_split_settings
+    for extra_split, min_scene_len, target_split in settings:
+        boost["scene_detection_extra_split"] = extra_split
+        boost["scene_detection_min_scene_len"] = min_scene_len
+        boost["scene_detection_target_split"] = target_split
+        for i in range(check_split_arrays):
+            frames = int(rng.integers(2, 6000))
+            if i % 2 == 0:
+                diffs = np.minimum(rng.exponential(0.05, size=frames), 0.99) + rng.choice([0.0, 1.0, 2.0], size=frames, p=[0.97, 0.02, 0.01])
+            else:
+                diffs = rng.choice([0.0, 0.5, 1.0, 1.12, 1.14, 1.16, 2.0], size=frames)
+            diffs[0] = 1.0
+            great_diffs = diffs.copy()
+            great_diffs[great_diffs < 1.0] = 0
+            print(f"\033[KChecking split {extra_split} / {min_scene_len} / {target_split} / {frames} frames", end="\r")
+            expected = check_split_scene(great_diffs, diffs, 0, frames, extra_split, min_scene_len, target_split)
+            with open(os.devnull, "w") as devnull_f, contextlib.redirect_stdout(devnull_f):
+                boost["scene_detection_argmax_table"] = boost["scene_detection_build_argmax"](diffs)
+                actual = boost["scene_detection_split_scene"](diffs, 0, frames)
+            if [int(frame) for frame in actual] != [int(frame) for frame in expected]:
+                print(f"\033[KSplit differs with `scene_detection_extra_split` {extra_split}, `scene_detection_min_scene_len` {min_scene_len}, " +
+                      f"`scene_detection_target_split` {target_split} on {"tie-heavy" if i % 2 else "random"} diffs of {frames} frames")
+                print(f"Expected {[int(frame) for frame in expected]}")
+                print(f"Got      {[int(frame) for frame in actual]}")
+                return False
+    print(f"\033[KSplit matches on {len(settings) * check_split_arrays} diffs")
+    return True
+
+# This is the 0.05 step scan `metric_solve_crf` replaced. It returns the final `--crf` and whether the scene is reported as potential low
+# quality.
+def check_scene_crf(model, iterate_crfs):
+    for n in range(boost["testing_crfs"].shape[0] + 1):
+        if boost["metric_better_metric"](model(iterate_crfs[n]), boost["metric_target"]):
+            if n == boost["testing_crfs"].shape[0]:
+                return iterate_crfs[n], False
+        else:
+            for crf in np.arange(iterate_crfs[n] - 0.05, iterate_crfs[n-1] - 0.005, -0.05):
+                if boost["metric_better_metric"](model(crf - 0.005), boost["metric_target"]):
+                    return crf, False
+            return iterate_crfs[n-1], True
+    assert False
+
+check_crf_models = 1000
+
+# The models are cubic fits of the synthetic quantisers, moved up or down so that some of them are worse than `metric_target` even at
+# `final_min_crf` and some are better even at `final_max_crf`. Each model is checked with the config, and with `final_min_crf` and
+# `final_max_crf` at the lowest and highest `testing_crfs`, where the ranges at both ends are empty.
+def check_crf():
+    rng = default_rng(0)
+    testing_crfs = boost["testing_crfs"]
+    iterate_crfs_config = boost["metric_iterate_crfs"]
+    iterate_crfs_equal = np.append(testing_crfs, [testing_crfs[-1], testing_crfs[0]])
+    quantisers = synthetic_quantisers(check_crf_models)
+    scene = {"start_frame": 0, "end_frame": 0}
+    try:
+        for i in range(check_crf_models):
+            model = np.poly1d(np.polyfit(testing_crfs, quantisers[i], min(3, testing_crfs.shape[0] - 1))) + rng.uniform(-30, 30)
+            for bounds, iterate_crfs in [("config", iterate_crfs_config), ("equal", iterate_crfs_equal)]:
+                print(f"\033[KChecking crf {i} / {bounds} bounds", end="\r")
+                boost["metric_iterate_crfs"] = iterate_crfs
+                expected = check_scene_crf(model, iterate_crfs)
+                reports = []
+                actual = boost["metric_scene_crf"](i, scene, model, reports), len(reports) > 0
+                if actual[0] != expected[0] or actual[1] != expected[1]:
+                    print(f"\033[KCrf differs with {bounds} bounds for model {model.coeffs.tolist()}")
+                    print(f"Expected {expected[0]:.2f}{" with potential low quality" if expected[1] else ""}")
+                    print(f"Got      {actual[0]:.2f}{" with potential low quality" if actual[1] else ""}")
+                    return False
+    finally:
+        boost["metric_iterate_crfs"] = iterate_crfs_config
+    print(f"\033[KCrf matches on {check_crf_models} models")
+    return True
+
+
+# Progress lines printed by the functions are written to devnull so that the terminal doesn't count towards the time.
+# Tracing memory slows down Python code by several times, so the peak memory is measured in a separate run after the timed runs.
+def benchmark_time(run):
+    with open(os.devnull, "w") as devnull_f, contextlib.redirect_stdout(devnull_f):
+        start = perf_counter()
+        run()
+        return perf_counter() - start
+
+def benchmark_memory(run):
+    tracemalloc.start()
+    try:
+        with open(os.devnull, "w") as devnull_f, contextlib.redirect_stdout(devnull_f):
+            run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# `scene_detection_split_scene` recurses once for every split.
+sys.setrecursionlimit(max(sys.getrecursionlimit(), 2 * max(frames for frames, _ in benchmark_cases.values()) // max(boost["scene_detection_min_scene_len"], 1) + 1000))
+
+if args.check:
+    checked = [check_split(), check_crf()]
+    sys.exit(0 if all(checked) else 1)
+
+results = []
+print(f"{"Case":<8} {"Benchmark":<12} {"Items":>8} {"Best (s)":>10} {"Throughput":>22} {"Peak memory":>12}")
+for case, (frames, count) in benchmark_cases.items():
+    for benchmark in benchmark_benchmarks:
+        print(f"\033[K{case:<8} {benchmark:<12} Preparing", end="\r")
+        prepared = benchmark_functions[benchmark](frames, count)
+        if prepared is None:
+            print(f"\033[K{case:<8} {benchmark:<12} Skipped / VapourSynth is not available")
+            continue
+        run, items, unit = prepared
+        timings = []
+        for repeat in range(args.repeat):
+            print(f"\033[K{case:<8} {benchmark:<12} Run {repeat + 1} / {args.repeat}", end="\r")
+            timings.append(benchmark_time(run))
+        best = min(timings)
+        print(f"\033[K{case:<8} {benchmark:<12} Measuring memory", end="\r")
+        peak = benchmark_memory(run)
+        print(f"\033[K{case:<8} {benchmark:<12} {items:>8} {best:>10.4f} {f"{items / best:.1f} {unit}/s":>22} {f"{peak / 1048576:.1f} MiB":>12}")
+        results.append({"case": case, "frames": frames, "scenes": count, "benchmark": benchmark, "items": items, "unit": unit,
+                        "best": best, "timings": timings, "peak_memory": peak})
+
+if args.output:
+    with args.output.open("w") as output_f:
+        json.dump({"script": str(args.script), "platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__, "results": results}, output_f, indent=2)
@@ -22,53 +22,142 @@
 
 
 import argparse
+import atexit
 from collections.abc import Callable
-from functools import partial
-from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+import hashlib
+import inspect
+from itertools import groupby
 import json
 import math
 import numpy as np
-from numpy.random import default_rng
 import os
 from pathlib import Path
 import platform
+from queue import Empty, Queue
 from scipy.optimize import Bounds, minimize
 from scipy.stats import median_abs_deviation
+import shutil
 import subprocess
-from time import time
+import sys
+import threading
+from time import perf_counter, sleep, time
+from types import SimpleNamespace
 import vapoursynth as vs
 from vapoursynth import core
 
 parser = argparse.ArgumentParser(prog="Progression Boost", epilog="For more configs, open `Progression-Boost.py` in a text editor and follow the guide at the very top")
-parser.add_argument("-i", "--input", type=Path, required=True, help="Source video file")
-parser.add_argument("--encode-input", type=Path, help="Source file for test encodes. Supports both video file and vpy file (Default: same as `--input`). This file is only used to perform test encodes, while scene detection will be performed using the video file specified in `--input`, and filtering before metric calculation can be set in the `Progression-Boost.py` file itself")
-parser.add_argument("-o", "--output-zones", type=Path, help="Output zones file for encoding")
-parser.add_argument("--output-scenes", type=Path, help="Output scenes file for encoding")
-parser.add_argument("--output-roi-maps", type=Path, help="Directory for output ROI maps, relative or absolute. The paths to ROI maps are written into output scenes or zones file")
-parser.add_argument("--temp", type=Path, help="Temporary folder for Progression Boost (Default: output zones or scenes file with file extension replaced by „.boost.tmp“)")
-parser.add_argument("-r", "--resume", action="store_true", help="Resume from the temporary folder. By enabling this option, Progression Boost will reuse finished or unfinished testing encodes. This should be disabled should the parameters for test encode be changed")
+parser.add_argument("-i", "--input", type=Path, action="append", required=True, help="Source video file. Specify this multiple times to boost multiple episodes in a batch, in which case scene detection, test encodes and metric calculation of different episodes run at the same time. In a batch, each of the options below, if used, needs to be specified once for every `--input` in the same order")
+parser.add_argument("--encode-input", type=Path, action="append", help="Source file for test encodes. Supports both video file and vpy file (Default: same as `--input`). This file is only used to perform test encodes, while scene detection will be performed using the video file specified in `--input`, and filtering before metric calculation can be set in the `Progression-Boost.py` file itself")
+parser.add_argument("-o", "--output-zones", type=Path, action="append", help="Output zones file for encoding")
+parser.add_argument("--output-scenes", type=Path, action="append", help="Output scenes file for encoding")
+parser.add_argument("--output-roi-maps", type=Path, action="append", help="Directory for output ROI maps, relative or absolute. The paths to ROI maps are written into output scenes or zones file")
+parser.add_argument("--temp", type=Path, action="append", help="Temporary folder for Progression Boost (Default: output zones or scenes file with file extension replaced by „.boost.tmp“)")
+parser.add_argument("-r", "--resume", action="store_true", help="Resume from the temporary folder. By enabling this option, Progression Boost will reuse finished or unfinished testing encodes, as well as metric scores already calculated for these test encodes. This should be disabled should the parameters for test encode be changed")
 parser.add_argument("--verbose", action="store_true", help="Progression Boost by default only reports scenes that have received big boost, or scenes that have built unexpected polynomial model. By enabling this option, all scenes will be reported")
-args = parser.parse_args()
-input_file = args.input
-testing_input_file = args.encode_input
-if testing_input_file is None:
-    testing_input_file = input_file
-zones_file = args.output_zones
-scenes_file = args.output_scenes
-roi_maps_dir = args.output_roi_maps
-if not zones_file and not scenes_file:
-    parser.print_usage()
-    print("Progression Boost: error: at least one of the following arguments is required: -o/--output-zones, --output-scenes")
-    raise SystemExit(2)
-temp_dir = args.temp
-if not temp_dir:
-    if zones_file:
-        temp_dir = zones_file.with_suffix(".boost.tmp")
+parser.add_argument("--metric-workers", type=int, default=1, help="Number of scenes to calculate metric and build model for concurrently (Default: 1). Increase this to keep the GPU or vszip busy while other scenes are selecting frames and fitting models. The result is the same regardless of the number of workers")
+parser.add_argument("--profile", action="store_true", help="Record the time spent in each stage, each test encode and each scene, as well as the peak memory usage. The timings are written to „profile.trace.json“ in the temporary folder, which can be opened in Perfetto or `chrome://tracing`, and a summary is printed when Progression Boost exits")
+
+# Every source file is opened only once and the same node is shared by scene detection, metric calculation and character boosting, as well as
+# by all runs in the same process. BestSource indexes are kept in `source_index_dir` under a key from the path, size and modification time of
+# the file, and are reused across runs. When run from the commandline, this is the `source-index` folder in the temporary folder.
+source_index_dir = None
+source_nodes = {}
+source_lock = threading.Lock()
+def source_key(file):
+    file = file.expanduser().resolve()
+    stat = file.stat()
+    return file, hashlib.sha1(f"{file}\n{stat.st_size}\n{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+
+def source_open(file):
+    file, key = source_key(file)
+    with source_lock:
+        if key not in source_nodes:
+            if source_index_dir is None:
+                source_nodes[key] = core.bs.VideoSource(str(file))
+            else:
+                source_nodes[key] = core.bs.VideoSource(str(file), cachemode=2, cachepath=str(source_index_dir.joinpath(key)))
+        return source_nodes[key]
+
+# This releases the node and the decoder cache of a source that's no longer needed.
+def source_close(file):
+    _, key = source_key(file)
+    with source_lock:
+        source_nodes.pop(key, None)
+
+# With `--profile`, each span from `profile_begin` to `profile_end` is recorded as a complete event in Chrome's trace format.
+# Spans are put on the lane of the thread they run in, or on the lane named `lane` such as for test encodes that overlap with each other.
+profile_enable = False
+profile_events = []
+profile_lanes = {}
+profile_lock = threading.Lock()
+profile_start = perf_counter()
+def profile_lane(key, name):
+    with profile_lock:
+        if key not in profile_lanes:
+            profile_lanes[key] = (len(profile_lanes), name)
+        return profile_lanes[key][0]
+
+def profile_begin(name, category, lane=None, **arguments):
+    if not profile_enable:
+        return None
+    if lane is None:
+        tid = profile_lane(threading.get_ident(), threading.current_thread().name)
     else:
-        temp_dir = scenes_file.with_suffix(".boost.tmp")
-temp_dir.mkdir(parents=True, exist_ok=True)
-testing_resume = args.resume
-metric_verbose = args.verbose
+        tid = profile_lane(lane, lane)
+    return name, category, tid, arguments, perf_counter()
+
+def profile_end(span):
+    if span is None:
+        return
+    end = perf_counter()
+    name, category, tid, arguments, begin = span
+    with profile_lock:
+        profile_events.append({"name": name, "cat": category, "ph": "X", "ts": (begin - profile_start) * 1e6, "dur": (end - begin) * 1e6, "pid": os.getpid(), "tid": tid, "args": arguments})
+
+# This records every call of the function as a span, with the first argument recorded under the name `index`.
+def profile_function(name, category, index=None):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*arguments, **kwarguments):
+            span = profile_begin(name, category, **({index: int(arguments[0])} if index is not None else {}))
+            try:
+                return function(*arguments, **kwarguments)
+            finally:
+                profile_end(span)
+        return wrapper
+    return decorator
+
+# The peak resident memory of Progression Boost itself and of the largest child process such as av1an, in bytes.
+def profile_peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    scale = 1 if platform.system() == "Darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+def profile_write(profile_file):
+    peak_self, peak_children = profile_peak_memory()
+    with profile_lock:
+        events = sorted(profile_events, key=lambda event: event["ts"])
+        lanes = list(profile_lanes.values())
+    trace = {"traceEvents": [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}} for tid, name in lanes] + events,
+             "displayTimeUnit": "ms",
+             "otherData": {"peak_memory": peak_self, "peak_memory_children": peak_children}}
+    with profile_file.open("w") as profile_f:
+        json.dump(trace, profile_f)
+
+    summary = {}
+    for event in events:
+        summary.setdefault((event["cat"], event["name"]), []).append(event["dur"] / 1e6)
+    print(f"\033[KProfile written to {profile_file}")
+    print(f"{"Category":<10} {"Span":<32} {"Count":>7} {"Total (s)":>11} {"Mean (s)":>10} {"Max (s)":>10}")
+    for (category, name), durations in summary.items():
+        print(f"{category:<10} {name:<32} {len(durations):>7} {np.sum(durations):>11.3f} {np.mean(durations):>10.4f} {np.max(durations):>10.4f}")
+    if peak_self is not None:
+        print(f"Peak memory / Progression Boost {peak_self / 1048576:.0f} MiB / Largest child process {peak_children / 1048576:.0f} MiB")
 
 
 # ---------------------------------------------------------------------
@@ -144,6 +233,24 @@ testing_crfs = np.sort([10.00, 15.00, 20.00, 25.00, 30.00, 35.00, 40.00, 45.00,
 # multiples of 0.25. Progression Boost will break if this requirement
 # is not followed.
 # ---------------------------------------------------------------------
+# Instead of encoding every `--crf` in `testing_crfs` for the whole
+# video, Progression Boost can also encode a few coarse `--crf`s for
+# the whole video first, and then encode the rest of `testing_crfs`
+# only for the scenes that are not settled yet.
+# A scene is considered settled if, in the model built from the coarse
+# test encodes, the `--crf` in `testing_crfs` closest to its predicted
+# final `--crf` is already one of the coarse `--crf`s. Scenes with an
+# unreliable model are never considered settled.
+#
+# This cuts the time spent on test encodes by a lot, but settled scenes
+# are boosted using a model built from fewer test encodes. Enable
+# progressive test encodes by setting the line below to True.
+testing_progressive = False
+# Specify the coarse `--crf`s. These must be a part of `testing_crfs`,
+# and should include the lowest and the highest `--crf` in
+# `testing_crfs`.
+testing_progressive_crfs = np.sort([10.00, 25.00, 40.00, 60.00])
+# ---------------------------------------------------------------------
 # Do you want to change other parameters than `--crf` dynamically
 # during the test encode? This function receives a `--crf` value and
 # should return a string of parameters for the encoder.
@@ -378,6 +485,34 @@ scene_detection_target_split = 60
 scene_detection_method = "vapoursynth".lower()
 # scene_detection_vapoursynth_method = "wwxd_scxvid".lower() # Preferred
 scene_detection_vapoursynth_method = "wwxd".lower() # Fast
+#
+# VapourSynth-based scene detection decodes the source in one process,
+# which only keeps a few cores busy. Progression Boost can instead split
+# the source into segments and measure them in multiple processes at
+# the same time. Specify the number of processes here, or set this to 1
+# to measure everything in one process.
+# WWXD and the frame diff only look at each frame and the frame before
+# it, and give exactly the same result either way. Scxvid, however,
+# carries its state from the frames before, so for `wwxd_scxvid`, each
+# process starts measuring this number of frames before its segment.
+scene_detection_vapoursynth_processes = 1
+scene_detection_vapoursynth_warmup_frames = 240
+#
+# With VapourSynth-based scene detection, Progression Boost can start
+# the test encodes while scene detection is still running, instead of
+# waiting for the whole source to go through WWXD and Scxvid. To do
+# this, scenes are created section by section. Each section ends at the
+# frame with the highest diff within `scene_detection_extra_split`
+# frames from its start, and the section is settled as soon as another
+# `scene_detection_min_scene_len` frames are detected after that. The
+# scenes created this way are slightly different from the scenes
+# created from the whole source at once.
+# The test encodes are then run on parts of the source as soon as they
+# are settled, with each part at least the number of frames below, and
+# the parts are joined with mkvmerge at the end. mkvmerge from
+# MKVToolNix needs to be installed for this.
+scene_detection_streaming = False
+scene_detection_streaming_part_frames = 7200
 # ---------------------------------------------------------------------
 # ---------------------------------------------------------------------
 # Specify the av1an parameters for the test encodes. You need to
@@ -393,13 +528,26 @@ testing_av1an_parameters = "--workers 48 --chunk-method bestsource --pix-format
 # Below are the parameters that should always be used. Regular users
 # would not need to modify these.
 testing_av1an_parameters += " -y"
+#
+# At the end of each test encode, the last few long chunks often leave
+# most of the workers idle. Progression Boost can run multiple test
+# encodes at the same time, and start the next test encode using the
+# workers left idle by the previous one. The `--workers` specified
+# above is shared by all concurrent test encodes.
+# When more than one test encode is running, the output of av1an is
+# written to `test-encode-XX.log` in the temporary folder instead.
+# Specify the maximum number of test encodes to run at the same time.
+# Set this to 1 to run test encodes one after another.
+testing_concurrent_passes = 3
 # ---------------------------------------------------------------------
 # ---------------------------------------------------------------------
 # Once the test encodes finish, Progression Boost will start
 # calculating metric for each scenes.
 # If you want to do some filtering before calculating, you can modify
-# the following lines. Otherwise you can leave it unchanged.
-metric_reference = core.bs.VideoSource(input_file.expanduser().resolve())
+# the following lines. Otherwise you can leave it unchanged. The source
+# video file is given in `input_file`.
+def metric_source(input_file: Path) -> vs.VideoNode:
+    return source_open(input_file)
 # ---------------------------------------------------------------------
 # Additionally, you can also apply some filters to both the source and
 # the encoded clip before calculating metric. By default, no processing
@@ -455,7 +603,8 @@ metric_highest_diff_min_separation = 10
 # while also reducing `metric_highest_diff_frames` to 2.
 metric_upper_diff_bracket_frames = 4
 metric_lower_diff_bracket_frames = 4
-# We select frames from the two brackets randomly, but we want to avoid
+# We select frames from the two brackets randomly, using a fixed seed so
+# the same frames are picked every time, but we want to avoid
 # picking a frame in the lower bracket right after a frame from the
 # upper bracket, because these two frames are most likely exactly the
 # same.
@@ -478,22 +627,76 @@ metric_first_frame = 0
 # of a scene slightly worse than the rest of the frames. Do you want to
 # always include the first frame in metric calculation?
 metric_last_frame = 1
+#
+# By default, Progression Boost first collects the frames picked from
+# all the scenes, and then calculates metric for all of them in a
+# single long pass for each test encode. This keeps the GPU busy
+# instead of spinning up a tiny calculation for every scene for every
+# test encode. Set this to False to calculate metric scene by scene.
+metric_batched = True
+#
+# With the option above enabled, Progression Boost can also calculate
+# metric for each test encode as soon as it finishes, while the next
+# test encodes are still running. The output of av1an is written to
+# `test-encode-XX.log` in the temporary folder in this mode. Set this
+# to False to start calculating metric only after all test encodes
+# finish.
+metric_pipelined = True
+#
+# Also with `metric_batched` enabled, the frames picked are read from
+# each test encode strictly from front to back, a chunk of frames at
+# a time, before metric is calculated on them. With `--keyint -1`,
+# requesting the frames out of order can make the decoder go back to
+# the start of a scene again and again. Set this to False to let
+# VapourSynth request the picked frames directly.
+metric_sequential_read = True
+#
+# This is the number of frames read from each test encode at a time
+# with the option above enabled. The next frames are read while metric
+# is being calculated for the current ones, so twice this number of
+# frames from both the source and the test encode are held in memory at
+# the same time. Lower this if you're running out of RAM.
+metric_sequential_read_frames = 96
 # ---------------------------------------------------------------------
 # ---------------------------------------------------------------------
+# You don't need to modify anything here.
+def metric_calculate_multiple(*calculates):
+    return partial(metric_calculate_merge, calculates)
+def metric_calculate_merge(calculates, reference, distorted):
+    clips = [calculate(reference, distorted) for calculate in calculates]
+    def merge(n, f):
+        fout = f[0].copy()
+        for f_ in f[1:]:
+            for key, value in f_.props.items():
+                if key not in fout.props:
+                    fout.props[key] = value
+        return fout
+    return clips[0].std.ModifyFrame(clips, merge)
+# ---------------------------------------------------------------------
 # What metric do you want to use? Are you hipping, or are you zipping?
+#
+# The frame props listed in `metric_props` are stored for every frame
+# measured in the temporary folder, and `metric_metric` is calculated
+# from the stored frame props. As long as all the frame props that
+# `metric_metric` uses are stored, you can change `metric_metric`,
+# `metric_better_metric` and `metric_summarise` afterwards, and run
+# again with `--resume` without calculating metric again.
 # 
 # To use SSIMU2 via vship, uncomment the lines below. 
 # metric_calculate = core.vship.SSIMULACRA2
+# metric_props = ["_SSIMULACRA2"]
 # metric_metric = lambda frame: frame.props["_SSIMULACRA2"]
 # metric_better_metric = np.greater
 
 # To use Butteraugli 3Norm via vship, uncomment the lines below.
 # metric_calculate = core.vship.BUTTERAUGLI
+# metric_props = ["_BUTTERAUGLI_3Norm", "_BUTTERAUGLI_INFNorm"]
 # metric_metric = lambda frame: frame.props["_BUTTERAUGLI_3Norm"]
 # metric_better_metric = np.less
 
 # To use Butteraugli INFNorm via vship, uncomment the lines below.
 # metric_calculate = core.vship.BUTTERAUGLI
+# metric_props = ["_BUTTERAUGLI_3Norm", "_BUTTERAUGLI_INFNorm"]
 # metric_metric = lambda frame: frame.props["_BUTTERAUGLI_INFNorm"]
 # metric_better_metric = np.less
 
@@ -503,13 +706,22 @@ metric_last_frame = 1
 # the tiny spice of Butteraugli INFNorm patches some of the small
 # issues Butteraugli 3Norm missed.
 # metric_calculate = core.vship.BUTTERAUGLI
+# metric_props = ["_BUTTERAUGLI_3Norm", "_BUTTERAUGLI_INFNorm"]
 # metric_metric = lambda frame: frame.props["_BUTTERAUGLI_3Norm"] * 0.97 + frame.props["_BUTTERAUGLI_INFNorm"] * 0.03
 # metric_better_metric = np.less
 
 # To use SSIMU2 via vszip, uncomment the lines below.
 metric_calculate = partial(core.vszip.Metrics, mode=0)
+metric_props = ["_SSIMULACRA2"]
 metric_metric = lambda frame: frame.props["_SSIMULACRA2"]
 metric_better_metric = np.greater
+
+# If you want to switch between SSIMU2 and Butteraugli later without
+# calculating metric again, you can calculate both of them via vship in
+# a single pass using the lines below, and then pick `metric_metric`
+# and `metric_better_metric` from any of the options above.
+# metric_calculate = metric_calculate_multiple(core.vship.SSIMULACRA2, core.vship.BUTTERAUGLI)
+# metric_props = ["_SSIMULACRA2", "_BUTTERAUGLI_3Norm", "_BUTTERAUGLI_INFNorm"]
 # ---------------------------------------------------------------------
 # You don't need to modify anything here.
 class UnreliableSummarisationError(Exception):
@@ -639,7 +851,7 @@ def metric_model(crfs: np.ndarray[float], quantisers: np.ndarray[float]) -> Call
         fit = minimize(objective, [0, *np.polyfit(crfs, quantisers, 2)],
                        method="SLSQP", options={"ftol": 1e-6}, bounds=bounds, constraints=constraints)
         if fit.success and not np.isclose(fit.x[0], 0, rtol=0, atol=1e-7):
-            return partial(polynomial, coef=fit.x)
+            return np.poly1d(fit.x)
 
     if crfs.shape[0] >= 3:
         polynomial = lambda X, coef: coef[0] * X ** 2 + coef[1] * X + coef[2]
@@ -656,7 +868,7 @@ def metric_model(crfs: np.ndarray[float], quantisers: np.ndarray[float]) -> Call
         fit = minimize(objective, [0, *np.polyfit(crfs, quantisers, 1)],
                        method="SLSQP", options={"ftol": 1e-6}, bounds=bounds, constraints=constraints)
         if fit.success and not np.isclose(fit.x[0], 0, rtol=0, atol=1e-7):
-            return partial(polynomial, coef=fit.x)
+            return np.poly1d(fit.x)
 
     if crfs.shape[0] >= 2:
         polynomial = lambda X, coef: coef[0] * X + coef[1]
@@ -670,21 +882,14 @@ def metric_model(crfs: np.ndarray[float], quantisers: np.ndarray[float]) -> Call
                        method="L-BFGS-B", options={"ftol": 1e-6}, bounds=bounds)
         if fit.success and not np.isclose(fit.x[0], 0, rtol=0, atol=1e-7):
             if not crfs.shape[0] >= 3:
-                return partial(polynomial, coef=fit.x)
+                return np.poly1d(fit.x)
             else:
                 def cut(crf):
-                    if crf <= np.average([crfs[-1], final_max_crf], weights=[3, 1]):
-                        return polynomial(crf, fit.x)
-                    else:
-                        return np.nan
+                    return np.where(crf <= np.average([crfs[-1], final_max_crf], weights=[3, 1]), polynomial(crf, fit.x), np.nan)
                 return cut
 
     def cut(crf):
-        for i in range(0, crfs.shape[0]):
-            if crf <= crfs[i]:
-                return quantisers[i]
-        else:
-            return np.nan
+        return np.append(quantisers, np.nan)[np.searchsorted(crfs, crf, side="left")]
     raise UnreliableModelError(cut, f"Unable to construct a polynomial model. This may result in overboosting.")
 
 # For Butteraugli 3Norm, as explained in the `testing_crfs` section,
@@ -709,18 +914,11 @@ def metric_model(crfs: np.ndarray[float], quantisers: np.ndarray[float]) -> Call
 #                     method="L-BFGS-B", options={"ftol": 1e-6}, bounds=bounds)
 #     if fit.success and not np.isclose(fit.x[0], 0, rtol=0, atol=1e-7):
 #         def predict(crf):
-#             if crf >= 11:
-#                 return polynomial(crf, fit.x)
-#             else:
-#                 return polynomial(12 - (12 - crf) ** 1.12, fit.x)
+#             return polynomial(np.where(crf >= 11, crf, 12 - np.abs(12 - crf) ** 1.12), fit.x)
 #         return predict
 # 
 #     def cut(crf):
-#         for i in range(0, crfs.shape[0]):
-#             if crf <= crfs[i]:
-#                 return quantisers[i]
-#         else:
-#             return np.nan
+#         return np.append(quantisers, np.nan)[np.searchsorted(crfs, crf, side="left")]
 #     raise UnreliableModelError(cut, f"Test encodes with higher `--crf` received better score than encodes with lower `--crf`. This may result in overboosting.")
 
 # If you want to use a different method, you can implement it here.
@@ -728,7 +926,10 @@ def metric_model(crfs: np.ndarray[float], quantisers: np.ndarray[float]) -> Call
 # This function receives quantisers corresponding to each test encodes
 # specified previously in `testing_crfs`, which is provided in the
 # first argument `crfs`. It should return a function that will return
-# predicted metric score when called with `--crf`.
+# predicted metric scores when called with a numpy array of `--crf`s.
+# If the model is a polynomial, return it as a `np.poly1d`, and the
+# `--crf` that meets `metric_target` will be solved from its roots
+# instead of searched step by step.
 # You should raise an UnreliableModelError with a model and an error
 # message if the model constructed is unreliable. You will have to
 # return a model in the exception. If the model constructed is
@@ -777,12 +978,6 @@ if character_enable:
 
 
 if character_enable:
-    if not roi_maps_dir:
-        parser.print_usage()
-        print("Progression Boost: error: the following arguments is required: --output-roi-maps")
-        raise SystemExit(2)
-    roi_maps_dir.mkdir(exist_ok=True)
-
     character_model = Path(vsmlrt.models_path) / "anime-segmentation" / "isnet_is.onnx"
     if not character_model.exists():
         print(f"Progression Boost: error: Could not find anime-segmentation model at \"{character_model}\". Acquire it from https://github.com/AmusementClub/vs-mlrt/releases/external-models")
@@ -816,479 +1011,1438 @@ if character_enable:
 if platform.system() == "Windows":
     os.system("")
 
-# Scene dectection
-scene_detection_scenes_file = temp_dir.joinpath("scenes-detection.scenes.json")
-scene_detection_diffs_file = temp_dir.joinpath("scenes-detection.diff.txt")
-
-if scene_detection_method == "av1an":
-    if not testing_resume or not scene_detection_scenes_file.exists():
-        scene_detection_scenes_file.unlink(missing_ok=True)
+# Test encodes from all runs in the same process share the `--workers` in `testing_av1an_parameters`. `testing_running` holds the test
+# encodes currently running from all runs, and `testing_waiting` holds the runs that have test encodes waiting to start, in the order they
+# requested. Only the first run in `testing_waiting` may start a new test encode.
+testing_lock = threading.Lock()
+testing_running = []
+testing_waiting = []
+# If test encodes are run one after another, only one test encode from all runs is running at any time.
+testing_sequential_lock = threading.Lock()
+
+# VapourSynth-based scene detection measures the frames of this clip. It's created the same way in the main process and in the worker
+# processes for `scene_detection_vapoursynth_processes`.
+def scene_detection_vapoursynth_clip(input_file, vapoursynth_method):
+    clip = source_open(input_file)
+    bits = clip.format.bits_per_sample
+    clip = clip.std.PlaneStats(clip[0] + clip, plane=0, prop="Luma")
+    target_width = np.round(np.sqrt(1280 * 720 / clip.width / clip.height) * clip.width / 40) * 40
+    if target_width < clip.width * 0.9:
+        target_height = np.ceil(target_width / clip.width * clip.height / 2) * 2
+        src_height = target_height / target_width * clip.width
+        src_top = (clip.height - src_height) / 2
+        clip = clip.resize.Point(width=target_width, height=target_height, src_top=src_top, src_height=src_height,
+                                 format=vs.YUV420P8, dither_type="none")
+    clip = clip.wwxd.WWXD()
+    if vapoursynth_method == "wwxd_scxvid":
+        clip = clip.scxvid.Scxvid()
+    return clip, bits
+
+def scene_detection_vapoursynth_props(frame, vapoursynth_method):
+    return (frame.props["LumaDiff"], frame.props["LumaMin"], frame.props["LumaMax"],
+            frame.props["Scenechange"], frame.props["_SceneChangePrev"] if vapoursynth_method == "wwxd_scxvid" else -1)
+
+# Each worker process runs this script with `scene_detection_worker_command` and measures the frames from `start_frame` to `end_frame` into
+# the frame props table in `frames_file`, starting `warmup_frames` earlier. `Scenechange` is written last for each frame, since it marks the
+# frame as measured for the main process.
+scene_detection_worker_command = "import json, runpy, sys; runpy.run_path(sys.argv[1])[\"scene_detection_worker\"](*json.loads(sys.argv[2]))"
+def scene_detection_worker(input_file, index_dir, vapoursynth_method, frames_file, start_frame, end_frame, warmup_frames):
+    global source_index_dir
+    source_index_dir = Path(index_dir) if index_dir is not None else None
+    clip, _ = scene_detection_vapoursynth_clip(Path(input_file), vapoursynth_method)
+    frames = np.load(frames_file, mmap_mode="r+")
+    warmup_start_frame = max(start_frame - warmup_frames, 0)
+    for current_frame, frame in enumerate(clip[warmup_start_frame:end_frame].frames(backlog=48), start=warmup_start_frame):
+        if current_frame >= start_frame:
+            props = scene_detection_vapoursynth_props(frame, vapoursynth_method)
+            frames[current_frame] = props[:3] + (-1,) + props[4:]
+            frames["Scenechange"][current_frame] = props[3]
+    frames.flush()
+
+# Progression Boost runs on one source at a time in `progression_boost_run`, which yields the name of each stage once it's finished.
+# Everything belonging to a run lives inside the function, while the config above, the VapourSynth core and the opened sources are shared by
+# all runs in the same process.
+def progression_boost_run(input_file, testing_input_file, zones_file, scenes_file, roi_maps_dir, temp_dir, testing_resume, metric_verbose, metric_workers, testing_stop):
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    if character_enable:
+        assert roi_maps_dir, "`output_roi_maps` is required for character boosting."
+        roi_maps_dir.mkdir(exist_ok=True)
+
+    # Test encodes
+    # The test encodes are set up before scene detection so that they can be started during scene detection with `scene_detection_streaming`.
+    # The `--workers` in `testing_av1an_parameters` is the budget shared by all test encodes running at the same time.
+    testing_av1an_parameters_ = testing_av1an_parameters.split()
+    testing_workers = None
+    for flag in ["--workers", "-w"]:
+        if flag in testing_av1an_parameters_:
+            testing_workers = int(testing_av1an_parameters_[testing_av1an_parameters_.index(flag) + 1])
+            del testing_av1an_parameters_[testing_av1an_parameters_.index(flag):testing_av1an_parameters_.index(flag) + 2]
+
+    def testing_command(crf, encode_input_file, encode_scenes_file, name, workers):
+        # If you want to use a different encoder than SVT-AV1 derived ones, modify here. This is not tested and may have additional issues.
         command = [
             "av1an",
-            "--temp", str(temp_dir.joinpath("scenes-detection.tmp")),
-            "-i", str(input_file),
-            "--scenes", str(scene_detection_scenes_file),
-            *scene_detection_parameters.split()
+            "--temp", str(temp_dir.joinpath(f"{name}.tmp")),
+            "--keep"
+        ]
+        if testing_resume:
+            command += ["--resume"]
+        command += [
+            "-i", str(encode_input_file),
+            "-o", str(temp_dir.joinpath(f"{name}.mkv")),
+            "--scenes", str(encode_scenes_file),
+            *testing_av1an_parameters_
+        ]
+        if workers is not None:
+            command += ["--workers", str(workers)]
+        command += [
+            "--video-params", f"--crf {crf:.2f} {testing_dynamic_parameters(crf)} {testing_parameters}"
         ]
-        subprocess.run(command, text=True, check=True)
-    assert scene_detection_scenes_file.exists()
+        return command
 
-    with scene_detection_scenes_file.open("r") as scenes_f:
-        scenes = json.load(scenes_f)
+    def testing_finish(n, crf, name):
+        assert temp_dir.joinpath(f"{name}.mkv").exists()
 
-    if not testing_resume or not scene_detection_diffs_file.exists():
-        scene_detection_clip = core.bs.VideoSource(input_file.expanduser().resolve())
-        scene_detection_bits = scene_detection_clip.format.bits_per_sample
-        scene_detection_clip = scene_detection_clip.std.PlaneStats(scene_detection_clip[0] + scene_detection_clip, plane=0, prop="Luma")
-        
-        start = time() - 0.000001
-        scene_detection_diffs = np.empty((scene_detection_clip.num_frames,), dtype=float)
-        for current_frame, frame in enumerate(scene_detection_clip.frames(backlog=48)):
-            print(f"\033[KFrame {current_frame} / Calculating frame diff / {current_frame / (time() - start):.02f} fps", end="\r")
-            scene_detection_diffs[current_frame] = frame.props["LumaDiff"]
-        print(f"\033[KFrame {current_frame} / Frame diff calculation complete / {current_frame / (time() - start):.02f} fps")
+        for metric_cache_file in temp_dir.glob(f"metric-scores-*-crf{crf:.2f}.npy"):
+            metric_cache_file.unlink()
 
-        np.savetxt(scene_detection_diffs_file, scene_detection_diffs, fmt="%.9f")
-    else:
-        scene_detection_diffs = np.loadtxt(scene_detection_diffs_file)
+        temp_dir.joinpath(f"{name}.lwi").unlink(missing_ok=True)
 
-elif scene_detection_method == "vapoursynth":
-    if not testing_resume or not scene_detection_scenes_file.exists() or not scene_detection_diffs_file.exists():
+    # The number of chunks not yet finished in a running test encode, read from av1an's `chunks.json` and `done.json`.
+    # If these files are not available yet, the test encode is assumed to be using all its workers.
+    def testing_remaining_chunks(name):
+        try:
+            with temp_dir.joinpath(f"{name}.tmp", "chunks.json").open("r") as chunks_f:
+                total = len(json.load(chunks_f))
+            with temp_dir.joinpath(f"{name}.tmp", "done.json").open("r") as done_f:
+                done = len(json.load(done_f)["done"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, None
+        return total - done, total
+
+    # Each pass is a tuple of (n, crf, encode_input_file, encode_scenes_file, name).
+    # This returns the n of the passes that are actually encoded, which are not reused from `--resume`.
+    # If `finished` is given, (n, whether the pass is actually encoded) is put into it as soon as each pass is available.
+    # Test encodes running in the background stop as soon as `testing_stop` is set, which happens when a stage of the run fails.
+    def testing_encode(passes, finished=None):
+        if finished is not None:
+            for pass_ in passes:
+                if testing_resume and temp_dir.joinpath(f"{pass_[4]}.mkv").exists():
+                    finished.put((pass_[0], False))
+        passes = [pass_ for pass_ in passes if not testing_resume or not temp_dir.joinpath(f"{pass_[4]}.mkv").exists()]
+
+        if testing_concurrent_passes <= 1 or testing_workers is None:
+            for n, crf, encode_input_file, encode_scenes_file, name in passes:
+                with testing_sequential_lock:
+                    span = profile_begin("Test encode", "encode", lane=f"{temp_dir.name} / Test encode {n:0>2}", n=n, crf=float(crf))
+                    if finished is None:
+                        subprocess.run(testing_command(crf, encode_input_file, encode_scenes_file, name, testing_workers), text=True, check=True)
+                    else:
+                        command = testing_command(crf, encode_input_file, encode_scenes_file, name, testing_workers)
+                        with temp_dir.joinpath(f"{name}.log").open("w") as log_f:
+                            popen = subprocess.Popen(command, stdout=log_f, stderr=subprocess.STDOUT, text=True)
+                            try:
+                                while popen.poll() is None and not testing_stop.is_set():
+                                    testing_stop.wait(1)
+                            finally:
+                                if popen.poll() is None:
+                                    popen.terminate()
+                                    popen.wait()
+                        if testing_stop.is_set():
+                            return []
+                        if popen.returncode != 0:
+                            raise subprocess.CalledProcessError(popen.returncode, command)
+                    profile_end(span)
+                testing_finish(n, crf, name)
+                if finished is not None:
+                    finished.put((n, True))
+            return [pass_[0] for pass_ in passes]
+
+        # A new test encode is only started if at least a quarter of the workers are idle, since it keeps the same number of workers till the end.
+        queue = list(passes)
+        running = []
+        spans = {}
+        waiting = object()
+        if queue:
+            with testing_lock:
+                testing_waiting.append(waiting)
+        # `testing_running` and `testing_waiting` are shared with other runs in the same process, so the entries of this run are always
+        # removed, and the test encodes of this run still running are stopped, however this run ends.
+        try:
+            while queue or running:
+                if testing_stop.is_set():
+                    return []
+                for process in list(running):
+                    (n, crf, _, _, name), command, workers, log_f, popen, _ = process
+                    if (returncode := popen.poll()) is not None:
+                        log_f.close()
+                        running.remove(process)
+                        with testing_lock:
+                            testing_running.remove(process)
+                        if returncode != 0:
+                            raise subprocess.CalledProcessError(returncode, command)
+                        profile_end(spans.pop(n))
+                        testing_finish(n, crf, name)
+                        print(f"\033[KTest encode {n:0>2} complete")
+                        if finished is not None:
+                            finished.put((n, True))
+                if not queue and not running:
+                    break
+
+                with testing_lock:
+                    busy = 0
+                    progress = []
+                    for process in testing_running:
+                        (n, _, _, _, _), _, workers, _, _, remaining_chunks = process
+                        remaining, total = remaining_chunks()
+                        if remaining is None:
+                            busy += workers
+                        else:
+                            busy += min(workers, remaining)
+                        if any(process is process_ for process_ in running):
+                            progress.append(f"{n:0>2}: starting" if remaining is None else f"{n:0>2}: {total - remaining}/{total} chunks")
+
+                    if queue and testing_waiting[0] is waiting and len(testing_running) < testing_concurrent_passes and testing_workers - busy >= max(testing_workers // 4, 1):
+                        n, crf, encode_input_file, encode_scenes_file, name = queue[0]
+                        command = testing_command(crf, encode_input_file, encode_scenes_file, name, testing_workers - busy)
+                        log_f = temp_dir.joinpath(f"{name}.log").open("w")
+                        try:
+                            popen = subprocess.Popen(command, stdout=log_f, stderr=subprocess.STDOUT, text=True)
+                        except BaseException:
+                            log_f.close()
+                            raise
+                        spans[n] = profile_begin("Test encode", "encode", lane=f"{temp_dir.name} / Test encode {n:0>2}", n=n, crf=float(crf), workers=testing_workers - busy)
+                        process = (queue.pop(0), command, testing_workers - busy, log_f, popen, partial(testing_remaining_chunks, name))
+                        running.append(process)
+                        testing_running.append(process)
+                        if not queue:
+                            testing_waiting.remove(waiting)
+                        print(f"\033[KTest encode {n:0>2} started with {testing_workers - busy} workers")
+                        continue
+
+                print(f"\033[KTest encodes / {" / ".join(progress)}", end="\r")
+                testing_stop.wait(1)
+        finally:
+            with testing_lock:
+                for process in running:
+                    testing_running.remove(process)
+                if waiting in testing_waiting:
+                    testing_waiting.remove(waiting)
+            for _, _, _, log_f, popen, _ in running:
+                if popen.poll() is None:
+                    popen.terminate()
+                log_f.close()
+
+        return [pass_[0] for pass_ in passes]
+
+    # For progressive test encodes, the scenes that are not settled are put together in a vpy file and a scenes file of their own.
+    # With `scene_detection_streaming`, each part of the source is also encoded from a vpy file and a scenes file of its own.
+    # `ranges` is the [start_frame, end_frame] of each scene to be put together.
+    testing_progressive_input_file = temp_dir.joinpath("test-encode-progressive.vpy")
+    testing_progressive_scenes_file = temp_dir.joinpath("test-encode-progressive.scenes.json")
+    testing_progressive_file = temp_dir.joinpath("test-encode-progressive.json")
+    def testing_write_input(encode_input_file, encode_scenes_file, ranges):
+        with encode_input_file.open("w") as vpy_f:
+            vpy_f.write(f"""import runpy
+import vapoursynth as vs
+from vapoursynth import core
+
+input_file = {repr(str(testing_input_file.expanduser().resolve()))}
+if input_file.lower().endswith(".vpy"):
+    runpy.run_path(input_file, run_name="__vapoursynth__")
+    clip = vs.get_output(0)
+    vs.clear_outputs()
+    if isinstance(clip, vs.VideoOutputTuple):
+        clip = clip.clip
+else:
+    clip = core.bs.VideoSource(input_file)
+
+clip = core.std.Splice([clip[start_frame:end_frame] for start_frame, end_frame in {json.dumps(ranges)}])
+clip.set_output()
+""")
+
+        progressive_scenes = {"frames": 0, "scenes": []}
+        for start_frame, end_frame in ranges:
+            progressive_scenes["scenes"].append({"start_frame": progressive_scenes["frames"], "end_frame": progressive_scenes["frames"] + end_frame - start_frame, "zone_overrides": None})
+            progressive_scenes["frames"] += end_frame - start_frame
+        with encode_scenes_file.open("w") as scenes_f:
+            json.dump(progressive_scenes, scenes_f)
+
+    # With `scene_detection_streaming`, this runs in the background during scene detection and encodes each part put into `parts` as a tuple of
+    # (part number, ranges). `parts` gets None once scene detection is complete, or False if scene detection has failed.
+    # The parts of each test encode are then joined into the same `test-encode-XX.mkv` as a test encode of the whole source.
+    # The return value and `finished` are the same as `testing_encode`.
+    def testing_encode_streaming(parts, finished):
+        passes = [(n, crf) for n, crf in enumerate(testing_crfs) if not testing_progressive or crf in testing_progressive_crfs]
+        for n, _ in passes:
+            if testing_resume and temp_dir.joinpath(f"test-encode-{n:0>2}.mkv").exists():
+                finished.put((n, False))
+        passes = [(n, crf) for n, crf in passes if not testing_resume or not temp_dir.joinpath(f"test-encode-{n:0>2}.mkv").exists()]
+
+        part_count = 0
+        while part := parts.get():
+            p, ranges = part
+            encode_input_file = temp_dir.joinpath(f"test-encode-part-{p:0>3}.vpy")
+            encode_scenes_file = temp_dir.joinpath(f"test-encode-part-{p:0>3}.scenes.json")
+            testing_write_input(encode_input_file, encode_scenes_file, ranges)
+            # Giving `testing_encode` a queue keeps the output of av1an in the log files while scene detection is printing its progress.
+            testing_encode([(n, crf, encode_input_file, encode_scenes_file, f"test-encode-{n:0>2}-part-{p:0>3}") for n, crf in passes], Queue())
+            if testing_stop.is_set():
+                return []
+            part_count += 1
+        if part is False:
+            return []
+
+        for n, crf in passes:
+            name = f"test-encode-{n:0>2}"
+            part_files = [temp_dir.joinpath(f"{name}-part-{p:0>3}.mkv") for p in range(part_count)]
+            command = ["mkvmerge", "-q", "-o", str(temp_dir.joinpath(f"{name}.mkv")), str(part_files[0])]
+            for part_file in part_files[1:]:
+                command += ["+", str(part_file)]
+            # mkvmerge exits with 1 if there are only warnings.
+            if (returncode := subprocess.run(command, text=True).returncode) >= 2:
+                raise subprocess.CalledProcessError(returncode, command)
+            for part_file in part_files:
+                part_file.unlink()
+            testing_finish(n, crf, name)
+            print(f"\033[KTest encode {n:0>2} joined from {part_count} parts")
+            finished.put((n, True))
+        return [n for n, _ in passes]
+
+
+    # Scene dectection
+    profile_scene_detection = profile_begin("Scene detection", "stage")
+    scene_detection_stream = None
+    scene_detection_scenes_file = temp_dir.joinpath("scenes-detection.scenes.json")
+    # Frame props collected during scene detection are stored in a binary table that can be memory-mapped on `--resume`.
+    # `Scenechange` and `_SceneChangePrev` are -1 for frames that are not measured by WWXD or Scxvid.
+    scene_detection_frames_file = temp_dir.joinpath("scenes-detection.frames.npy")
+    scene_detection_frames_temp_file = temp_dir.joinpath("scenes-detection.frames.tmp.npy")
+    scene_detection_config_file = temp_dir.joinpath("scenes-detection.config.json")
+    scene_detection_frames_dtype = np.dtype([("LumaDiff", np.float64), ("LumaMin", np.float64), ("LumaMax", np.float64),
+                                             ("Scenechange", np.int8), ("_SceneChangePrev", np.int8)])
+    def scene_detection_create_frames(num_frames):
+        return np.lib.format.open_memmap(scene_detection_frames_temp_file, mode="w+", dtype=scene_detection_frames_dtype, shape=(num_frames,))
+    # The table must be flushed and every reference to it dropped before calling this, since a file that is still mapped can't be renamed on
+    # Windows.
+    def scene_detection_finish_frames():
+        scene_detection_frames_temp_file.replace(scene_detection_frames_file)
+
+    if scene_detection_method == "av1an":
+        # The frame diff doesn't depend on the scenes from av1an, so it's calculated while av1an is detecting scenes, and the two decodes of the
+        # source run at the same time instead of one after another.
+        scene_detection_av1an = None
+        if not testing_resume or not scene_detection_scenes_file.exists():
+            scene_detection_scenes_file.unlink(missing_ok=True)
+            command = [
+                "av1an",
+                "--temp", str(temp_dir.joinpath("scenes-detection.tmp")),
+                "-i", str(input_file),
+                "--scenes", str(scene_detection_scenes_file),
+                *scene_detection_parameters.split()
+            ]
+            scene_detection_av1an = subprocess.Popen(command, text=True)
+
+        try:
+            if not testing_resume or not scene_detection_frames_file.exists():
+                scene_detection_clip = source_open(input_file)
+                scene_detection_bits = scene_detection_clip.format.bits_per_sample
+                scene_detection_clip = scene_detection_clip.std.PlaneStats(scene_detection_clip[0] + scene_detection_clip, plane=0, prop="Luma")
+
+                start = time() - 0.000001
+                scene_detection_frames = scene_detection_create_frames(scene_detection_clip.num_frames)
+                for current_frame, frame in enumerate(scene_detection_clip.frames(backlog=48)):
+                    # The progress is only printed after av1an finishes so that it doesn't garble the progress bar from av1an.
+                    if scene_detection_av1an is None or scene_detection_av1an.poll() is not None:
+                        print(f"\033[KFrame {current_frame} / Calculating frame diff / {current_frame / (time() - start):.02f} fps", end="\r")
+                    scene_detection_frames[current_frame] = (frame.props["LumaDiff"], frame.props["LumaMin"], frame.props["LumaMax"], -1, -1)
+                print(f"\033[KFrame {current_frame} / Frame diff calculation complete / {current_frame / (time() - start):.02f} fps")
+
+                scene_detection_frames.flush()
+                del scene_detection_frames
+                scene_detection_finish_frames()
+
+            if scene_detection_av1an is not None:
+                if (returncode := scene_detection_av1an.wait()) != 0:
+                    raise subprocess.CalledProcessError(returncode, scene_detection_av1an.args)
+        except BaseException:
+            if scene_detection_av1an is not None and scene_detection_av1an.poll() is None:
+                scene_detection_av1an.terminate()
+            raise
+        assert scene_detection_scenes_file.exists()
+
+        with scene_detection_scenes_file.open("r") as scenes_f:
+            scenes = json.load(scenes_f)
+
+    elif scene_detection_method == "vapoursynth":
         assert scene_detection_extra_split >= scene_detection_min_scene_len * 2, "`scene_detection_method` `vapoursynth` does not support `scene_detection_extra_split` to be smaller than 2 times `scene_detection_min_scene_len`."
-    
-        scene_detection_clip = core.bs.VideoSource(input_file.expanduser().resolve())
-        scene_detection_bits = scene_detection_clip.format.bits_per_sample
-        scene_detection_clip = scene_detection_clip.std.PlaneStats(scene_detection_clip[0] + scene_detection_clip, plane=0, prop="Luma")
-        target_width = np.round(np.sqrt(1280 * 720 / scene_detection_clip.width / scene_detection_clip.height) * scene_detection_clip.width / 40) * 40
-        if target_width < scene_detection_clip.width * 0.9:
-            target_height = np.ceil(target_width / scene_detection_clip.width * scene_detection_clip.height / 2) * 2
-            src_height = target_height / target_width * scene_detection_clip.width
-            src_top = (scene_detection_clip.height - src_height) / 2
-            scene_detection_clip = scene_detection_clip.resize.Point(width=target_width, height=target_height, src_top=src_top, src_height=src_height,
-                                                                     format=vs.YUV420P8, dither_type="none")
-        scene_detection_clip = scene_detection_clip.wwxd.WWXD()
         try:
-            if scene_detection_vapoursynth_method == "wwxd_scxvid":
-                scene_detection_clip = scene_detection_clip.scxvid.Scxvid()
+            assert scene_detection_vapoursynth_method in ["wwxd", "wwxd_scxvid"], "Invalid `scene_detection_vapoursynth_method`. Please check your config inside `Progression-Boost.py`."
         except NameError:
             assert False, "You need to select a `scene_detection_vapoursynth_method` to use `scene_detection_method` `vapoursynth`. Please check your config inside `Progression-Boost.py`."
-            
-        scene_detection_rjust_digits = math.floor(np.log10(scene_detection_clip.num_frames))
-        scene_detection_rjust = lambda frame: str(frame).rjust(scene_detection_rjust_digits)
-        
-        scenes = {}
-        scenes["frames"] = scene_detection_clip.num_frames
-        scenes["scenes"] = []
-
-        diffs = np.empty((scene_detection_clip.num_frames,), dtype=float)
-        diffs[0] = 1.0
-        scene_detection_diffs = np.empty((scene_detection_clip.num_frames,), dtype=float)
-        scene_detection_diffs[0] = 1.0
-        luma_scenecut_prev = True
-        def scene_detection_split_scene(great_diffs, diffs, start_frame, end_frame):
+
+        # The frame props from WWXD and Scxvid are kept in `scene_detection_frames_file`, and the settings used to create the scenes are kept in
+        # `scene_detection_config_file`. With `--resume`, if only `scene_detection_target_split`, `scene_detection_extra_split` or
+        # `scene_detection_min_scene_len` is changed, the scenes are created again from the stored frame props without decoding the source.
+        scene_detection_config = {
+            "vapoursynth_method": scene_detection_vapoursynth_method,
+            "target_split": scene_detection_target_split,
+            "extra_split": scene_detection_extra_split,
+            "min_scene_len": scene_detection_min_scene_len,
+            "streaming": scene_detection_streaming
+        }
+        if testing_resume and scene_detection_config_file.exists() and scene_detection_frames_file.exists():
+            with scene_detection_config_file.open("r") as config_f:
+                scene_detection_stored_config = json.load(config_f)
+            scene_detection_frames = np.load(scene_detection_frames_file, mmap_mode="r")
+            scene_detection_decode = np.any(scene_detection_frames["Scenechange"] == -1) or \
+                                     (scene_detection_vapoursynth_method == "wwxd_scxvid" and np.any(scene_detection_frames["_SceneChangePrev"] == -1))
+            del scene_detection_frames
+        else:
+            scene_detection_stored_config = None
+            scene_detection_decode = True
+
+        # This returns the diffs of frames from `start_frame` to `end_frame`. Each diff also depends on the frame before it.
+        def scene_detection_create_diffs(frames, start_frame, end_frame):
+            low_frame = max(start_frame - 1, 0)
+            frames = frames[low_frame:end_frame]
+            if scene_detection_vapoursynth_method == "wwxd":
+                scenecut = frames["Scenechange"] == 1
+            elif scene_detection_vapoursynth_method == "wwxd_scxvid":
+                scenecut = (frames["Scenechange"] == 1) + (frames["_SceneChangePrev"] == 1) / 2
+            # Modify here to 251.125 and 3.875 if your source has full instead of limited colour range
+            luma_scenecut = (frames["LumaMin"] > 231.125 * 2 ** (scene_detection_bits - 8)) | \
+                            (frames["LumaMax"] < 19.875 * 2 ** (scene_detection_bits - 8))
+            # A luma scenecut only counts if the previous frame is not a luma scenecut. Frame 1 never counts.
+            luma_scenecut_prev = np.concatenate(([True], luma_scenecut[:-1]))
+            if low_frame == 0:
+                luma_scenecut_prev[:2] = True
+
+            diffs = np.where(luma_scenecut & ~luma_scenecut_prev, frames["LumaDiff"] + 2.0, frames["LumaDiff"] + scenecut)
+            if low_frame == 0:
+                diffs[0] = 1.0
+            return diffs[start_frame - low_frame:]
+
+        # `scene_detection_split_scene` repeatedly looks for the frame with the highest diff among the frames satisfying a set of conditions.
+        # Each set of conditions is one or more ranges of frames, and the highest diff in a range is looked up from a sparse table in constant
+        # time. Ties are broken towards the later frame.
+        # The table can also be built for only a section of the frames from `start_frame` to `end_frame`. The first level of the table is the
+        # frame numbers themselves, so the section starts from `scene_detection_argmax_table[0][0]`.
+        def scene_detection_build_argmax(diffs, start_frame=0, end_frame=None):
+            argmax_table = [np.arange(start_frame, diffs.shape[0] if end_frame is None else end_frame)]
+            width = 1
+            while width * 2 <= argmax_table[0].shape[0]:
+                left = argmax_table[-1][:-width]
+                right = argmax_table[-1][width:]
+                argmax_table.append(np.where(diffs[right] >= diffs[left], right, left))
+                width *= 2
+            return argmax_table
+
+        def scene_detection_argmax(diffs, ranges):
+            best = None
+            for low, high in ranges:
+                if low > high:
+                    continue
+                level = (high - low + 1).bit_length() - 1
+                left = scene_detection_argmax_table[level][low - scene_detection_argmax_table[0][0]]
+                right = scene_detection_argmax_table[level][high - (1 << level) + 1 - scene_detection_argmax_table[0][0]]
+                current_frame = int(right if diffs[right] >= diffs[left] else left)
+                if best is None or diffs[current_frame] > diffs[best] or (diffs[current_frame] == diffs[best] and current_frame > best):
+                    best = current_frame
+            return best
+
+        def scene_detection_split_scene(diffs, start_frame, end_frame):
             print(f"\033[KFrame [{scene_detection_rjust(start_frame)}:{scene_detection_rjust(end_frame)}] / Creating scenes", end="\r")
 
             if end_frame - start_frame <= scene_detection_target_split or \
                end_frame - start_frame < 2 * scene_detection_min_scene_len:
                 return [start_frame]
 
-            great_diffs_sort = np.argsort(great_diffs)[::-1]
+            # Both sides of the split need to be at least `scene_detection_min_scene_len`
+            lowest = start_frame + scene_detection_min_scene_len
+            highest = min(end_frame - scene_detection_min_scene_len, diffs.shape[0] - 1)
+            # One of the sides of the split is at most `scene_detection_target_split`
+            target_ranges = [(lowest, min(highest, start_frame + scene_detection_target_split)),
+                             (max(lowest, end_frame - scene_detection_target_split), highest)]
+            # The split doesn't increase the number of `scene_detection_extra_split` long scenes needed beyond `limit`.
+            # `current_frame - start_frame` in `((j - 1) * scene_detection_extra_split, j * scene_detection_extra_split]` uses `j` scenes, and
+            # `end_frame - current_frame` is allowed `limit - j` scenes.
+            extra_split_ranges = lambda limit: [(max(lowest, start_frame + (j - 1) * scene_detection_extra_split + 1, end_frame - (limit - j) * scene_detection_extra_split),
+                                                 min(highest, start_frame + j * scene_detection_extra_split))
+                                                for j in range(1, math.ceil((end_frame - start_frame) / scene_detection_extra_split) + 1)]
 
             if end_frame - start_frame <= 2 * scene_detection_target_split:
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        break
-                    if current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len and \
-                       current_frame - start_frame <= scene_detection_target_split and end_frame - current_frame <= scene_detection_target_split:
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
+                current_frame = scene_detection_argmax(diffs, [(max(lowest, end_frame - scene_detection_target_split), min(highest, start_frame + scene_detection_target_split))])
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
 
             if end_frame - start_frame <= scene_detection_extra_split:
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        break
-                    if (current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len) and \
-                       (current_frame - start_frame <= scene_detection_target_split or end_frame - current_frame <= scene_detection_target_split):
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
-
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        return [start_frame]
-                    if current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len:
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
+                current_frame = scene_detection_argmax(diffs, target_ranges)
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+
+                current_frame = scene_detection_argmax(diffs, [(lowest, highest)])
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+                return [start_frame]
 
             else: # end_frame - start_frame > scene_detection_extra_split
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.12:
-                        break
-                    if (current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len) and \
-                       math.ceil((current_frame - start_frame) / scene_detection_extra_split) + \
-                       math.ceil((end_frame - current_frame) / scene_detection_extra_split) <= \
-                       math.ceil((end_frame - start_frame) / scene_detection_extra_split + 0.15):
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
-                               
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        break
-                    if (current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len) and \
-                       (current_frame - start_frame <= scene_detection_target_split or end_frame - current_frame <= scene_detection_target_split):
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
-
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        break
-                    if current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len:
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
-
-                diffs_sort = np.argsort(diffs, stable=True)[::-1]
-
-                for current_frame in diffs_sort:
-                    if (current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len) and \
-                       math.ceil((current_frame - start_frame) / scene_detection_extra_split) + \
-                       math.ceil((end_frame - current_frame) / scene_detection_extra_split) <= \
-                       math.ceil((end_frame - start_frame) / scene_detection_extra_split):
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
+                current_frame = scene_detection_argmax(diffs, extra_split_ranges(math.ceil((end_frame - start_frame) / scene_detection_extra_split + 0.15)))
+                if current_frame is not None and diffs[current_frame] >= 1.12:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+
+                current_frame = scene_detection_argmax(diffs, target_ranges)
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+
+                current_frame = scene_detection_argmax(diffs, [(lowest, highest)])
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+
+                current_frame = scene_detection_argmax(diffs, extra_split_ranges(math.ceil((end_frame - start_frame) / scene_detection_extra_split)))
+                if current_frame is not None:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
 
             assert False, "This indicates a bug in the original code. Please report this to the repository including this error message in full."
 
-        start = time() - 0.000001
-        for current_frame, frame in islice(enumerate(scene_detection_clip.frames(backlog=48)), 1, None):
-            print(f"\033[KFrame {current_frame} / Detecting scenes / {current_frame / (time() - start):.02f} fps", end="\r")
 
-            if scene_detection_vapoursynth_method == "wwxd":
-                scene_detection_scenecut = frame.props["Scenechange"] == 1
-            elif scene_detection_vapoursynth_method == "wwxd_scxvid":
-                scene_detection_scenecut = (frame.props["Scenechange"] == 1) + (frame.props["_SceneChangePrev"] == 1) / 2
+        # With `scene_detection_streaming`, scenes are created section by section. Each section ends at the frame with the highest diff within
+        # `scene_detection_extra_split` frames from its start. This needs `scene_detection_min_scene_len` more frames to be known after that, so
+        # that the next section is never shorter than `scene_detection_min_scene_len`.
+        scene_detection_section_frames = scene_detection_extra_split + scene_detection_min_scene_len
+        def scene_detection_anchor(diffs, start_frame):
+            lowest = start_frame + scene_detection_min_scene_len
+            highest = start_frame + scene_detection_extra_split
+            # Ties are broken towards the later frame.
+            return highest - int(np.argmax(diffs[lowest:highest + 1][::-1]))
+
+        def scene_detection_split_section(diffs, start_frame, end_frame):
+            nonlocal scene_detection_argmax_table
+            scene_detection_argmax_table = scene_detection_build_argmax(diffs, start_frame, end_frame)
+            return scene_detection_split_scene(diffs, start_frame, end_frame)
+
+        if scene_detection_decode:
+            scene_detection_clip, scene_detection_bits = scene_detection_vapoursynth_clip(input_file, scene_detection_vapoursynth_method)
+
+            start = time() - 0.000001
+            scene_detection_frames = scene_detection_create_frames(scene_detection_clip.num_frames)
+            if scene_detection_streaming:
+                # Settled sections are collected into parts, and each part is put into `scene_detection_stream` for `testing_encode_streaming`.
+                scene_detection_rjust_digits = math.floor(np.log10(scene_detection_frames.shape[0]))
+                scene_detection_rjust = lambda frame: str(frame).rjust(scene_detection_rjust_digits)
+                scene_detection_stream = Queue()
+                testing_finished = Queue()
+                testing_executor = ThreadPoolExecutor(max_workers=1)
+                testing_future = testing_executor.submit(testing_encode_streaming, scene_detection_stream, testing_finished)
+                scene_detection_stream_diffs = np.empty((scene_detection_frames.shape[0],), dtype=np.float64)
+                scene_detection_stream_start_frames = []
+                scene_detection_section_start = 0
+                scene_detection_part_start = 0
+                scene_detection_part = 0
+                def scene_detection_put_part(end_frame):
+                    start_frames = [frame for frame in scene_detection_stream_start_frames if frame >= scene_detection_part_start] + [end_frame]
+                    scene_detection_stream.put((scene_detection_part, [[start_frames[i], start_frames[i + 1]] for i in range(len(start_frames) - 1)]))
+                # This settles all the sections that can be settled with the frames before `end_frame` measured.
+                def scene_detection_stream_frames(end_frame):
+                    nonlocal scene_detection_section_start, scene_detection_part_start, scene_detection_part
+                    if end_frame - scene_detection_section_start < scene_detection_section_frames:
+                        return
+                    scene_detection_stream_diffs[scene_detection_section_start:end_frame] = \
+                        scene_detection_create_diffs(scene_detection_frames, scene_detection_section_start, end_frame)
+                    while end_frame - scene_detection_section_start >= scene_detection_section_frames:
+                        anchor_frame = scene_detection_anchor(scene_detection_stream_diffs, scene_detection_section_start)
+                        scene_detection_stream_start_frames.extend(scene_detection_split_section(scene_detection_stream_diffs, scene_detection_section_start, anchor_frame))
+                        scene_detection_section_start = anchor_frame
+                        if scene_detection_section_start - scene_detection_part_start >= scene_detection_streaming_part_frames:
+                            scene_detection_put_part(scene_detection_section_start)
+                            scene_detection_part_start = scene_detection_section_start
+                            scene_detection_part += 1
+            try:
+                if scene_detection_vapoursynth_processes <= 1:
+                    for current_frame, frame in enumerate(scene_detection_clip.frames(backlog=48)):
+                        print(f"\033[KFrame {current_frame} / Detecting scenes / {current_frame / (time() - start):.02f} fps", end="\r")
+                        scene_detection_frames[current_frame] = scene_detection_vapoursynth_props(frame, scene_detection_vapoursynth_method)
+                        if scene_detection_streaming:
+                            scene_detection_stream_frames(current_frame + 1)
+
+                else:
+                    # The source is split into 4 segments for each process, which are handed out to the processes in order, so that the frames
+                    # measured from the start of the source keep growing for `scene_detection_streaming`.
+                    # `Scenechange` is -1 for frames that are not yet measured.
+                    scene_detection_frames["Scenechange"] = -1
+                    scene_detection_frames["_SceneChangePrev"] = -1
+                    scene_detection_frames.flush()
+                    segment_frames = math.ceil(scene_detection_frames.shape[0] / (scene_detection_vapoursynth_processes * 4))
+                    segments = [(start_frame, min(start_frame + segment_frames, scene_detection_frames.shape[0])) for start_frame in range(0, scene_detection_frames.shape[0], segment_frames)]
+                    warmup_frames = scene_detection_vapoursynth_warmup_frames if scene_detection_vapoursynth_method == "wwxd_scxvid" else 0
+                    running = []
+                    try:
+                        while segments or running:
+                            for process in list(running):
+                                command, popen, slot, span = process
+                                if (returncode := popen.poll()) is not None:
+                                    running.remove(process)
+                                    profile_end(span)
+                                    if returncode != 0:
+                                        raise subprocess.CalledProcessError(returncode, command)
+                            while segments and len(running) < scene_detection_vapoursynth_processes:
+                                start_frame, end_frame = segments.pop(0)
+                                command = [sys.executable, "-c", scene_detection_worker_command, str(Path(__file__).resolve()),
+                                           json.dumps([str(input_file), None if source_index_dir is None else str(source_index_dir), scene_detection_vapoursynth_method,
+                                                       str(scene_detection_frames_temp_file), start_frame, end_frame, warmup_frames])]
+                                slot = min(set(range(scene_detection_vapoursynth_processes)) - {process[2] for process in running})
+                                span = profile_begin("Scene detection segment", "scene detection", lane=f"{temp_dir.name} / Scene detection {slot:0>2}",
+                                                     start_frame=start_frame, end_frame=end_frame)
+                                running.append((command, subprocess.Popen(command), slot, span))
+
+                            measured = scene_detection_frames["Scenechange"] != -1
+                            current_frame = np.count_nonzero(measured)
+                            print(f"\033[KFrame {current_frame} / Detecting scenes in {len(running)} processes / {current_frame / (time() - start):.02f} fps", end="\r")
+                            if scene_detection_streaming:
+                                scene_detection_stream_frames(scene_detection_frames.shape[0] if np.all(measured) else int(np.argmin(measured)))
+                            if running:
+                                sleep(1)
+                    except BaseException:
+                        for _, popen, _, _ in running:
+                            popen.terminate()
+                        raise
+                    current_frame = scene_detection_frames.shape[0] - 1
+                print(f"\033[KFrame {current_frame} / Scene detection complete / {current_frame / (time() - start):.02f} fps")
+
+                if scene_detection_streaming:
+                    scene_detection_stream_diffs[scene_detection_section_start:] = \
+                        scene_detection_create_diffs(scene_detection_frames, scene_detection_section_start, scene_detection_frames.shape[0])
+                    scene_detection_stream_start_frames += scene_detection_split_section(scene_detection_stream_diffs, scene_detection_section_start, scene_detection_frames.shape[0])
+                    scene_detection_put_part(scene_detection_frames.shape[0])
+                    scene_detection_stream.put(None)
+            except BaseException:
+                if scene_detection_streaming:
+                    scene_detection_stream.put(False)
+                raise
+            scene_detection_frames.flush()
+            del scene_detection_frames
+            scene_detection_finish_frames()
+            scene_detection_stored_config = None
+        else:
+            scene_detection_bits = scene_detection_stored_config["bits"]
+            print(f"\033[KReusing frame props from previous scene detection")
+
+        if scene_detection_stored_config is None or not scene_detection_scenes_file.exists() or \
+           {key: value for key, value in scene_detection_stored_config.items() if key != "bits"} != scene_detection_config:
+            scene_detection_frames = np.load(scene_detection_frames_file, mmap_mode="r")
+
+            scene_detection_rjust_digits = math.floor(np.log10(scene_detection_frames.shape[0]))
+            scene_detection_rjust = lambda frame: str(frame).rjust(scene_detection_rjust_digits)
+
+            diffs = scene_detection_create_diffs(scene_detection_frames, 0, scene_detection_frames.shape[0])
+
+            scenes = {}
+            scenes["frames"] = scene_detection_frames.shape[0]
+            scenes["scenes"] = []
+
+            if scene_detection_streaming:
+                start_frames = []
+                start_frame = 0
+                while start_frame < diffs.shape[0]:
+                    end_frame = scene_detection_anchor(diffs, start_frame) if diffs.shape[0] - start_frame >= scene_detection_section_frames else diffs.shape[0]
+                    start_frames += scene_detection_split_section(diffs, start_frame, end_frame)
+                    start_frame = end_frame
+                if scene_detection_stream is not None:
+                    assert start_frames == scene_detection_stream_start_frames, "This indicates a bug in the original code. Please report this to the repository including this error message in full."
             else:
-                assert False, "Invalid `scene_detection_vapoursynth_method`. Please check your config inside `Progression-Boost.py`."
-            # Modify here to 251.125 and 3.875 if your source has full instead of limited colour range
-            luma_scenecut = frame.props["LumaMin"] > 231.125 * 2 ** (scene_detection_bits - 8) or \
-                            frame.props["LumaMax"] < 19.875 * 2 ** (scene_detection_bits - 8)
+                scene_detection_argmax_table = scene_detection_build_argmax(diffs)
+                start_frames = scene_detection_split_scene(diffs, 0, len(diffs))
+            start_frames += [scene_detection_frames.shape[0]]
+            for i in range(len(start_frames) - 1):
+                scenes["scenes"].append({"start_frame": int(start_frames[i]), "end_frame": int(start_frames[i + 1]), "zone_overrides": None})
+            print(f"\033[KFrame [{scene_detection_rjust(start_frames[i])}:{scene_detection_rjust(start_frames[i + 1])}] / Scene creation complete")
+            del scene_detection_frames
+
+            with scene_detection_scenes_file.open("w") as scenes_f:
+                json.dump(scenes, scenes_f)
+            with scene_detection_config_file.open("w") as config_f:
+                json.dump({"bits": scene_detection_bits} | scene_detection_config, config_f)
+
+            if testing_resume and any(temp_dir.glob("test-encode-*.mkv")):
+                print(f"\033[KScenes have been created again. Finished test encodes are still based on the previous scenes. Run without `--resume` to redo them")
 
-            if luma_scenecut and not luma_scenecut_prev:
-                diffs[current_frame] = frame.props["LumaDiff"] + 2.0
-            else:
-                diffs[current_frame] = frame.props["LumaDiff"] + scene_detection_scenecut
-            scene_detection_diffs[current_frame] = frame.props["LumaDiff"]
-                
-            luma_scenecut_prev = luma_scenecut
-        print(f"\033[KFrame {current_frame} / Scene detection complete / {current_frame / (time() - start):.02f} fps")
-
-        great_diffs = diffs.copy()
-        great_diffs[great_diffs < 1.0] = 0
-        start_frames = scene_detection_split_scene(great_diffs, diffs, 0, len(diffs)) + [scene_detection_clip.num_frames]
-        for i in range(len(start_frames) - 1):
-            scenes["scenes"].append({"start_frame": int(start_frames[i]), "end_frame": int(start_frames[i + 1]), "zone_overrides": None})
-        print(f"\033[KFrame [{scene_detection_rjust(start_frames[i])}:{scene_detection_rjust(start_frames[i + 1])}] / Scene creation complete")
-    
-        with scene_detection_scenes_file.open("w") as scenes_f:
-            json.dump(scenes, scenes_f)
-        np.savetxt(scene_detection_diffs_file, scene_detection_diffs, fmt="%.9f")
+        else:
+            with scene_detection_scenes_file.open("r") as scenes_f:
+                scenes = json.load(scenes_f)
 
     else:
-        with scene_detection_scenes_file.open("r") as scenes_f:
-            scenes = json.load(scenes_f)
-        scene_detection_diffs = np.loadtxt(scene_detection_diffs_file)
-
-else:
-    assert False, "Invalid `scene_detection_method`."
-    
-
-# Testing
-for n, crf in enumerate(testing_crfs):
-    if not testing_resume or not temp_dir.joinpath(f"test-encode-{n:0>2}.mkv").exists():
-        # If you want to use a different encoder than SVT-AV1 derived ones, modify here. This is not tested and may have additional issues.
-        command = [
-            "av1an",
-            "--temp", str(temp_dir.joinpath(f"test-encode-{n:0>2}.tmp")),
-            "--keep"
-        ]
-        if testing_resume:
-            command += ["--resume"]
-        command += [
-            "-i", str(testing_input_file),
-            "-o", str(temp_dir.joinpath(f"test-encode-{n:0>2}.mkv")),
-            "--scenes", str(scene_detection_scenes_file),
-            *testing_av1an_parameters.split(),
-            "--video-params", f"--crf {crf:.2f} {testing_dynamic_parameters(crf)} {testing_parameters}"
-        ]
-        subprocess.run(command, text=True, check=True)
-        assert temp_dir.joinpath(f"test-encode-{n:0>2}.mkv").exists()
+        assert False, "Invalid `scene_detection_method`."
+
+    scene_detection_frames = np.load(scene_detection_frames_file, mmap_mode="r")
+    scene_detection_diffs = scene_detection_frames["LumaDiff"]
+    profile_end(profile_scene_detection)
+    yield "scene detection"
+
+
+    # Testing
+    # `testing_encoded` marks the test encodes that are done for each scene, and `testing_partial` marks the test encodes that are done only for a part of the scenes.
+    # `testing_done` marks the test encodes that have finished and are ready for metric calculation.
+    testing_encoded = np.ones((len(scenes["scenes"]), len(testing_crfs)), dtype=bool)
+    testing_partial = np.zeros((len(testing_crfs),), dtype=bool)
+    testing_done = np.zeros((len(testing_crfs),), dtype=bool)
+    testing_pipelined = metric_batched and metric_pipelined
+    if testing_progressive:
+        assert np.all(np.isin(testing_progressive_crfs, testing_crfs)), "`testing_progressive_crfs` must be a part of `testing_crfs`."
+        testing_encoded[:, ~np.isin(testing_crfs, testing_progressive_crfs)] = False
+
+    testing_passes = [(n, crf, testing_input_file, scene_detection_scenes_file, f"test-encode-{n:0>2}") for n, crf in enumerate(testing_crfs) if np.all(testing_encoded[:, n])]
+    if scene_detection_stream is not None:
+        # The test encodes have been started during scene detection in `testing_encode_streaming`.
+        if not testing_pipelined:
+            testing_future.result()
+            testing_executor.shutdown()
+            testing_done[[pass_[0] for pass_ in testing_passes]] = True
+    elif testing_pipelined:
+        # The test encodes run in the background, and each of them is measured as soon as it finishes in the metric section below.
+        testing_finished = Queue()
+        testing_executor = ThreadPoolExecutor(max_workers=1)
+        testing_future = testing_executor.submit(testing_encode, testing_passes, testing_finished)
+    else:
+        testing_encode(testing_passes)
+        testing_done[[pass_[0] for pass_ in testing_passes]] = True
+    yield "testing"
 
-        temp_dir.joinpath(f"test-encode-{n:0>2}.lwi").unlink(missing_ok=True)
 
+    # Metric
+    metric_reference = metric_source(input_file)
+    if zones_file:
+        zones_f = zones_file.open("w")
+
+    # Ding
+    metric_iterate_crfs = np.append(testing_crfs, [final_max_crf, final_min_crf])
+    metric_reporting_crf = testing_crfs[0]
+
+    # The final `--crf` within a range between two metric_iterate_crfs is the biggest `--crf` in 0.05 steps downwards from high_crf,
+    # whose predicted quality, with another 0.005 lower for numeric stability, is better than the target.
+    def metric_solve_crf(model, high_crf, low_crf):
+        crfs = np.arange(high_crf - 0.05, low_crf - 0.005, -0.05)
+        # This happens when `high_crf` and `low_crf` are the same, such as at `final_min_crf` for a potential low quality scene.
+        if crfs.shape[0] == 0:
+            return None
+        if isinstance(model, np.poly1d):
+            # Whether the predicted quality is better than the target only changes at the roots of model - metric_target.
+            # Only the first step and the steps right around each root need to be checked.
+            roots = np.real((model - metric_target).roots)
+            candidates = np.ceil((crfs[0] - 0.005 - roots) / 0.05)
+            candidates = np.concatenate(([0], candidates - 1, candidates, candidates + 1))
+            candidates = np.unique(candidates[(candidates >= 0) & (candidates < crfs.shape[0])]).astype(int)
+        else:
+            candidates = np.arange(crfs.shape[0])
+        better = metric_better_metric(model(crfs[candidates] - 0.005), metric_target)
+        if np.any(better):
+            return crfs[candidates[np.argmax(better)]]
+        else:
+            return None
+
+    metric_scene_rjust_digits = math.floor(np.log10(len(scenes["scenes"]))) + 1
+    metric_scene_rjust = lambda scene: str(scene).rjust(metric_scene_rjust_digits, "0")
+    metric_frame_rjust_digits = math.floor(np.log10(metric_reference.num_frames)) + 1
+    metric_frame_rjust = lambda frame: str(frame).rjust(metric_frame_rjust_digits)
+    metric_scene_frame_print = lambda scene, start_frame, end_frame: f"Scene {metric_scene_rjust(scene)} Frame [{metric_frame_rjust(start_frame)}:{metric_frame_rjust(end_frame)}]"
+
+    def metric_load_encode(n):
+        if not testing_done[n]:
+            # Test encodes that are not finished yet
+            return core.std.BlankClip(metric_reference)
+        elif testing_partial[n]:
+            # Test encodes for only a part of the scenes are put back to the frame numbers of the source, with blank frames for the scenes not encoded.
+            clip = source_open(temp_dir.joinpath(f"test-encode-{n:0>2}-progressive.mkv"))
+            segments = []
+            current_frame = 0
+            for encoded, group in groupby(zip(testing_encoded[:, n], scenes["scenes"]), key=lambda x: x[0]):
+                group = [scene for _, scene in group]
+                length = group[-1]["end_frame"] - group[0]["start_frame"]
+                if encoded:
+                    segments.append(clip[current_frame:current_frame + length])
+                    current_frame += length
+                else:
+                    segments.append(core.std.BlankClip(clip, length=length))
+            return core.std.Splice(segments)
+        else:
+            return source_open(temp_dir.joinpath(f"test-encode-{n:0>2}.mkv"))
+
+    metric_clips = metric_process([metric_reference] + [metric_load_encode(n) for n in range(len(testing_crfs))])
+
+    # The frame props in `metric_props` are stored per frame for each test encode in the temp folder, and are reused with `--resume`.
+    # The store is keyed by `metric_calculate` and `metric_process`, and is removed every time the test encode is redone.
+    # `metric_metric` is calculated from the stored frame props, so changing it doesn't need the metric to be calculated again.
+    def metric_fingerprint(function):
+        if isinstance(function, partial):
+            return f"{metric_fingerprint(function.func)} {metric_fingerprint(function.args)} {metric_fingerprint(function.keywords)}"
+        elif isinstance(function, (list, tuple)):
+            return f"[{", ".join([metric_fingerprint(item) for item in function])}]"
+        elif isinstance(function, dict):
+            return f"{{{", ".join([f"{key}: {metric_fingerprint(value)}" for key, value in function.items()])}}}"
+        elif isinstance(function, vs.Function):
+            return f"{function.plugin.namespace}.{function.name}"
+        elif callable(function):
+            try:
+                return inspect.getsource(function)
+            except (OSError, TypeError):
+                return repr(function)
+        else:
+            return repr(function)
+    metric_cache_key = hashlib.sha1("\n".join([metric_fingerprint(metric_source),
+                                               metric_fingerprint(metric_calculate),
+                                               metric_fingerprint(metric_process)]).encode()).hexdigest()[:16]
+
+    def metric_open_cache(crf):
+        cache = {}
+        for prop in metric_props:
+            metric_cache_file = temp_dir.joinpath(f"metric-scores-{metric_cache_key}-{prop}-crf{crf:.2f}.npy")
+            if metric_cache_file.exists() and (cache_ := np.load(metric_cache_file, mmap_mode="r+")).shape == (metric_clips[0].num_frames,):
+                cache[prop] = cache_
+            else:
+                cache[prop] = np.lib.format.open_memmap(metric_cache_file, mode="w+", dtype=float, shape=(metric_clips[0].num_frames,))
+                cache[prop][:] = np.nan
+        return cache
+    # The store for a test encode is only opened after the test encode has finished, since `testing_finish` removes the stale store, and a file
+    # that is still mapped can't be removed on Windows.
+    metric_cache = [metric_open_cache(crf) if testing_done[n] else None for n, crf in enumerate(testing_crfs)]
 
-# Metric
-if zones_file:
-    zones_f = zones_file.open("w")
+    def metric_cache_missing(n, frames):
+        return np.any([np.isnan(metric_cache[n][prop][frames]) for prop in metric_props], axis=0)
 
-# Ding
-metric_iterate_crfs = np.append(testing_crfs, [final_max_crf, final_min_crf])
-metric_reporting_crf = testing_crfs[0]
+    def metric_cache_store(n, frame_number, frame):
+        for prop in metric_props:
+            metric_cache[n][prop][frame_number] = frame.props[prop]
 
-metric_scene_rjust_digits = math.floor(np.log10(len(scenes["scenes"]))) + 1
-metric_scene_rjust = lambda scene: str(scene).rjust(metric_scene_rjust_digits, "0")
-metric_frame_rjust_digits = math.floor(np.log10(metric_reference.num_frames)) + 1
-metric_frame_rjust = lambda frame: str(frame).rjust(metric_frame_rjust_digits)
-metric_scene_frame_print = lambda scene, start_frame, end_frame: f"Scene {metric_scene_rjust(scene)} Frame [{metric_frame_rjust(start_frame)}:{metric_frame_rjust(end_frame)}]"
+    def metric_cache_scores(n, frames):
+        props = {prop: metric_cache[n][prop][frames] for prop in metric_props}
+        return np.array([metric_metric(SimpleNamespace(props={prop: props[prop][i] for prop in metric_props})) for i in range(frames.shape[0])], dtype=float)
 
-metric_clips = [metric_reference] + \
-               [core.bs.VideoSource(temp_dir.joinpath(f"test-encode-{n:0>2}.mkv").expanduser().resolve()) for n in range(len(testing_crfs))]
-metric_clips = metric_process(metric_clips)
+    def metric_cache_flush(n):
+        for cache in metric_cache[n].values():
+            cache.flush()
 
-if character_enable:
-    character_clip = core.bs.VideoSource(input_file.expanduser().resolve())
-
-    character_block_width = math.ceil(character_clip.width / 64)
-    character_block_height = math.ceil(character_clip.height / 64)
-    character_clip = character_clip.resize.Bicubic(filter_param_a=0, filter_param_b=0.5, \
-                                                   width=character_block_width*64, height=character_block_height*64, src_width=character_block_width*64, src_height=character_block_height*64, \
-                                                   format=vs.RGBS, primaries_in=1, matrix_in=1, transfer_in=1, range_in=0, transfer=13, range=1)
-    character_clip = vsmlrt.inference(character_clip, character_model, backend=character_backend)
-    character_clip = character_clip.akarin.Expr("x 0.95 > x 0 ?")
-
-    character_clip = character_clip.resize.Bicubic(filter_param_a=0, filter_param_b=0, \
-                                                   width=character_block_width, height=character_block_height)
-    character_clip = character_clip.akarin.Expr("x 2 *")
-    character_clip = character_clip.akarin.Expr("""
+    if character_enable:
+        character_clip = source_open(input_file)
+
+        character_block_width = math.ceil(character_clip.width / 64)
+        character_block_height = math.ceil(character_clip.height / 64)
+        character_clip = character_clip.resize.Bicubic(filter_param_a=0, filter_param_b=0.5, \
+                                                       width=character_block_width*64, height=character_block_height*64, src_width=character_block_width*64, src_height=character_block_height*64, \
+                                                       format=vs.RGBS, primaries_in=1, matrix_in=1, transfer_in=1, range_in=0, transfer=13, range=1)
+        character_clip = vsmlrt.inference(character_clip, character_model, backend=character_backend)
+        character_clip = character_clip.akarin.Expr("x 0.95 > x 0 ?")
+
+        character_clip = character_clip.resize.Bicubic(filter_param_a=0, filter_param_b=0, \
+                                                       width=character_block_width, height=character_block_height)
+        character_clip = character_clip.akarin.Expr("x 2 *")
+        character_clip = character_clip.akarin.Expr("""
 x[-1,-1] x[-1,0] x[-1,1] x[0,-1] x[0,0] x[0,1] x[1,-1] x[1,0] x[1,1] + + + + + + + + 9 / avg!
 avg@ x > avg@ x ? r!
 r@ 1 < r@ 1 ? r!
 r@ -1 > r@ -1 ?""")
 
-start = time() - 0.000001
-for i, scene in enumerate(scenes["scenes"]):
-    print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Calculating boost / {i / (time() - start):.02f} scenes per second", end="\r")
-    printing = False
-
-    rng = default_rng(1188246) # Guess what is this number. It's the easiest cipher out there.
-
-    # These frames are offset from `scene["start_frame"] + 1` and that's why they are offfset, not offset
-    offfset_frames = []
-    
-    scene_diffs = scene_detection_diffs[scene["start_frame"] + 1:scene["end_frame"]]
-    scene_diffs_sort = np.argsort(scene_diffs)[::-1]
-    picked = 0
-    for offfset_frame in scene_diffs_sort:
-        if picked >= metric_highest_diff_frames:
-            break
-        to_continue = False
-        for existing_frame in offfset_frames:
-            if np.abs(existing_frame - offfset_frame) < metric_highest_diff_min_separation:
-                to_continue = True
-                break
-        if to_continue:
-            continue
-        offfset_frames.append(offfset_frame)
-        picked += 1
-    
-    if metric_last_frame >= 1 and scene["end_frame"] - scene["start_frame"] - 2 not in offfset_frames:
-        offfset_frames.append(scene["end_frame"] - scene["start_frame"] - 2)
-
-    scene_diffs_percentile = np.percentile(scene_diffs, 40, method="linear")
-    scene_diffs_percentile_absolute_deviation = np.percentile(np.abs(scene_diffs - scene_diffs_percentile), 40, method="linear")
-    scene_diffs_upper_bracket_ = np.argwhere(scene_diffs > scene_diffs_percentile + 5 * scene_diffs_percentile_absolute_deviation).reshape((-1))
-    scene_diffs_lower_bracket_ = np.argwhere(scene_diffs <= scene_diffs_percentile + 5 * scene_diffs_percentile_absolute_deviation).reshape((-1))
-    scene_diffs_upper_bracket = np.empty_like(scene_diffs_upper_bracket_)
-    rng.shuffle((scene_diffs_upper_bracket__ := scene_diffs_upper_bracket_[:math.ceil(scene_diffs_upper_bracket_.shape[0] / 2)]))
-    scene_diffs_upper_bracket[::2] = scene_diffs_upper_bracket__
-    rng.shuffle((scene_diffs_upper_bracket__ := scene_diffs_upper_bracket_[-math.floor(scene_diffs_upper_bracket_.shape[0] / 2):]))
-    scene_diffs_upper_bracket[1::2] =scene_diffs_upper_bracket__
-    scene_diffs_lower_bracket = np.empty_like(scene_diffs_lower_bracket_)
-    rng.shuffle((scene_diffs_lower_bracket__ := scene_diffs_lower_bracket_[:math.ceil(scene_diffs_lower_bracket_.shape[0] / 2)]))
-    scene_diffs_lower_bracket[::2] = scene_diffs_lower_bracket__
-    rng.shuffle((scene_diffs_lower_bracket__ := scene_diffs_lower_bracket_[-math.floor(scene_diffs_lower_bracket_.shape[0] / 2):]))
-    scene_diffs_lower_bracket[1::2] = scene_diffs_lower_bracket__
-
-    picked = 0
-    for offfset_frame in scene_diffs_upper_bracket:
-        if picked >= metric_upper_diff_bracket_frames:
-            break
-        if offfset_frame in offfset_frames:
-            continue
-        offfset_frames.append(offfset_frame)
-        picked += 1
-    
-    if picked < metric_upper_diff_bracket_fallback_frames:
-        to_pick = metric_lower_diff_bracket_frames + metric_upper_diff_bracket_fallback_frames - picked
-    else:
-        to_pick = metric_lower_diff_bracket_frames
-
-    if metric_first_frame >= 1:
-        offfset_frames.append(-1)
-
-    picked = 0
-    for offfset_frame in scene_diffs_lower_bracket:
-        if picked >= to_pick:
-            break
-        to_continue = False
-        for existing_frame in offfset_frames:
-            if np.abs(existing_frame - offfset_frame) < metric_lower_diff_bracket_min_separation:
-                to_continue = True
-                break
-        if to_continue:
-            continue
-        offfset_frames.append(offfset_frame)
-        picked += 1
-        
-    frames = np.sort(offfset_frames) + (scene["start_frame"] + 1)
-
-    clips = []
-    for metric_clip in metric_clips:
-        clip = metric_clip[int(frames[0])]
-        for frame in frames:
-            clip += metric_clip[int(frame)]
-        clips.append(clip)
-        
-    printed = False
-    quantisers = np.empty((len(testing_crfs),), dtype=float)
-    for n in range(len(testing_crfs)):
-        scores = np.array([metric_metric(frame) for frame in metric_calculate(clips[0], clips[n + 1]).frames()])
-        try:
-            quantisers[n] = metric_summarise(scores)
-        except UnreliableSummarisationError as e:
-            if not printed:
-                print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Unreliable summarisation / {str(e)}")
-                printed = True
-                printing = True
-            quantisers[n] = e.score
+    # Frames for all the scenes are picked in one pass.
+    # Every frame of every scene, excluding the first frame of each scene, is laid out scene after scene in the arrays below, and each step of
+    # the selection runs over all the scenes at once.
+    # This returns the picked frames of all the scenes in order, together with the scene each frame belongs to.
+    def metric_pick_frames(scenes):
+        starts = np.array([scene["start_frame"] for scene in scenes], dtype=np.intp)
+        lengths = np.array([scene["end_frame"] for scene in scenes], dtype=np.intp) - starts - 1
+        begin = np.concatenate(([0], np.cumsum(lengths)))
+        count = int(begin[-1])
+        frame_scenes = np.repeat(np.arange(lengths.shape[0]), lengths)
+        offsets = np.arange(count) - begin[frame_scenes]
+        frames = starts[frame_scenes] + 1 + offsets
+        diffs = scene_detection_diffs[frames]
+
+        def keys(frames):
+            # The random order frames are picked from a bracket in only depends on the frame numbers and the seed, so that the frames picked
+            # for a scene don't depend on the other scenes.
+            seed = np.uint64(1188246) # Guess what is this number. It's the easiest cipher out there.
+            keys = (frames.astype(np.uint64) + np.uint64(1)) * np.uint64(0x9E3779B97F4A7C15) + seed
+            keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            return keys ^ (keys >> np.uint64(31))
+
+        def percentile(values, q):
+            # `np.percentile(values, q, method="linear")` for every scene, written out so that the result is exactly the same.
+            sorted_values = values[np.lexsort((values, frame_scenes))]
+            virtual = (lengths - 1) * (q / 100)
+            previous = np.floor(virtual)
+            gamma = virtual - previous
+            previous = np.minimum(previous.astype(np.intp), lengths - 1)
+            a = sorted_values[np.minimum(begin[:-1] + previous, count - 1)]
+            b = sorted_values[np.minimum(begin[:-1] + np.minimum(previous + 1, lengths - 1), count - 1)]
+            return np.where(gamma >= 0.5, b - (b - a) * (1 - gamma), a + (b - a) * gamma)
+
+        def ranks(groups):
+            # The index of each element within its group, for `groups` that are already sorted.
+            return np.arange(groups.shape[0]) - np.searchsorted(groups, groups, side="left")
+
+        def bracket_order(bracket):
+            # The frames of each scene's bracket, in the order they should be picked.
+            # This is the same as shuffling the first and the second half of the bracket and then alternating between the two halves.
+            positions = np.flatnonzero(bracket)
+            scenes = frame_scenes[positions]
+            halves = ranks(scenes) >= (np.bincount(scenes, minlength=lengths.shape[0]) + 1)[scenes] // 2
+            order = np.lexsort((keys(frames[positions]), halves, scenes))
+            slots = np.empty_like(order)
+            slots[order] = ranks(scenes[order] * 2 + halves[order]) * 2 + halves[order]
+            return positions[np.lexsort((slots, scenes))]
+
+        def block(eligible, positions, separation):
+            # Frames within `separation` of `positions` are no longer eligible.
+            if separation <= 0:
+                return
+            lower = np.maximum(positions - (separation - 1), begin[frame_scenes[positions]])
+            upper = np.minimum(positions + separation, begin[frame_scenes[positions] + 1])
+            blocked = np.bincount(lower, minlength=count + 1) - np.bincount(upper, minlength=count + 1)
+            eligible &= np.cumsum(blocked[:-1]) == 0
+
+        def separated(order, eligible, quotas, separation):
+            # Each round picks, for every scene, the first frame in `order` that is not within `separation` of any frame picked before.
+            # This gives the same frames as walking through `order` scene by scene and skipping the frames too close to the picked ones.
+            picked = []
+            quotas = quotas.copy()
+            for _ in range(int(quotas.max(initial=0))):
+                candidates = order[eligible[order] & (quotas[frame_scenes[order]] > 0)]
+                if candidates.shape[0] == 0:
+                    break
+                candidates = candidates[np.diff(frame_scenes[candidates], prepend=-1) != 0]
+                picked.append(candidates)
+                quotas[frame_scenes[candidates]] -= 1
+                eligible[candidates] = False
+                block(eligible, candidates, separation)
+            return np.concatenate(picked) if picked else np.empty((0,), dtype=np.intp)
+
+        picked = np.zeros((count,), dtype=bool)
+        picked[separated(np.lexsort((-offsets, -diffs, frame_scenes)), np.ones((count,), dtype=bool),
+                         np.full(lengths.shape, metric_highest_diff_frames), metric_highest_diff_min_separation)] = True
+
+        if metric_last_frame >= 1:
+            picked[begin[1:][lengths > 0] - 1] = True
+
+        diffs_percentile = percentile(diffs, 40)
+        upper = diffs > (diffs_percentile + 5 * percentile(np.abs(diffs - diffs_percentile[frame_scenes]), 40))[frame_scenes]
+
+        upper_order = bracket_order(upper)
+        upper_order = upper_order[~picked[upper_order]]
+        upper_order = upper_order[ranks(frame_scenes[upper_order]) < metric_upper_diff_bracket_frames]
+        picked[upper_order] = True
+        quotas = np.bincount(frame_scenes[upper_order], minlength=lengths.shape[0])
+        quotas = np.where(quotas < metric_upper_diff_bracket_fallback_frames,
+                          metric_lower_diff_bracket_frames + metric_upper_diff_bracket_fallback_frames - quotas,
+                          metric_lower_diff_bracket_frames)
+
+        eligible = ~upper
+        block(eligible, np.flatnonzero(picked), metric_lower_diff_bracket_min_separation)
+        if metric_first_frame >= 1:
+            eligible &= offsets + 1 >= metric_lower_diff_bracket_min_separation
+        picked[separated(bracket_order(~upper), eligible, quotas, metric_lower_diff_bracket_min_separation)] = True
+
+        if metric_first_frame >= 1:
+            order = np.argsort(np.concatenate((frames[picked], starts)), kind="stable")
+            return np.concatenate((frames[picked], starts))[order], np.concatenate((frame_scenes[picked], np.arange(starts.shape[0])))[order]
+        else:
+            return frames[picked], frame_scenes[picked]
+
+    # The frames picked for scene `i` are `metric_batch_frames[metric_batch_begin[i]:metric_batch_begin[i + 1]]`.
+    profile_frame_selection = profile_begin("Frame selection", "stage")
+    metric_batch_frames, metric_batch_scenes = metric_pick_frames(scenes["scenes"])
+    metric_batch_begin = np.searchsorted(metric_batch_scenes, np.arange(len(scenes["scenes"]) + 1), side="left")
+    profile_end(profile_frame_selection)
+
+    # A clip serving frames already read into memory.
+    def metric_stored_clip(template, frames):
+        blank = core.std.BlankClip(template, length=len(frames))
+        return blank.std.ModifyFrame(blank, lambda n, f: frames[n])
+
+    # All the frames picked from all the scenes that are not already in `metric_cache` are measured in one long pass for each test encode.
+    @profile_function("Metric measurement", "metric", index="n")
+    def metric_measure(n):
+        metric_batch_frames_ = metric_batch_frames[testing_encoded[metric_batch_scenes, n]]
+        metric_batch_missing = metric_batch_frames_[metric_cache_missing(n, metric_batch_frames_)]
+        if metric_batch_missing.shape[0] == 0:
+            return
 
-    try:
-        model = metric_model(testing_crfs, quantisers)
-    except UnreliableModelError as e:
-        if not np.all(metric_better_metric(quantisers, metric_target)):
-            print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Unreliable model / {str(e)}")
-            printing = True
-        model = e.model
-
-    final_crf = None
-    # This is in fact iterating metric_iterate_crfs, which is constructed above below the Ding comment.
-    for n in range(len(testing_crfs) + 1):
-        if metric_better_metric(model(metric_iterate_crfs[n]), metric_target):
-            if n == len(testing_crfs):
-                # This means even at final_max_crf, we are still higher than the target quality.
-                # We will just use final_max_crf as final_crf. It shouldn't matter.
-                final_crf = metric_iterate_crfs[n]
-                break
-            else:
-                # This means the point where predicted quality meets the target is in higher crf ranges.
-                # We will skip this range and continue.
-                continue
+        start = time() - 0.000001
+        if not metric_sequential_read:
+            span = profile_begin("Metric decode and calculation", "metric", n=n, frames=int(metric_batch_missing.shape[0]))
+            metric_batch_reference = core.std.Splice([metric_clips[0][int(frame)] for frame in metric_batch_missing])
+            metric_batch_clip = core.std.Splice([metric_clips[n + 1][int(frame)] for frame in metric_batch_missing])
+            for current_frame, frame in enumerate(metric_calculate(metric_batch_reference, metric_batch_clip).frames(backlog=48)):
+                print(f"\033[KFrame {current_frame} / Calculating metric for test encode {n:0>2} / {current_frame / (time() - start):.02f} fps", end="\r")
+                metric_cache_store(n, metric_batch_missing[current_frame], frame)
+            profile_end(span)
         else:
-            # Because we know from previous iteration that at metric_iterate_crfs[n-1], the predicted quality is higher than the target,
-            # and now at metric_iterate_crfs[n], the prediceted quality is lower than the target,
-            # this means the point where predicted quality meets the target is within this range between metric_iterate_crfs[n] and metric_iterate_crfs[n-1].
-            # The only exception is when n == 0, while will be dealt with later.
-            for crf in np.arange(metric_iterate_crfs[n] - 0.05, metric_iterate_crfs[n-1] - 0.005, -0.05):
-                if metric_better_metric((value := model(crf - 0.005)), metric_target): # Also numeric instability stuff
-                    # We've found the biggest --crf whose predicted quality is higher than the target.
-                    final_crf = crf
+            # The reference and the test encode are each read by a single thread in ascending order, so that the decoder never needs to seek backwards.
+            # The frames read are then served to `metric_calculate` from memory, while the next chunk is being read.
+            def metric_read_chunk(chunk_start):
+                chunk = metric_batch_missing[chunk_start:chunk_start + metric_sequential_read_frames]
+                return [executor.submit(lambda clip: [clip.get_frame(int(frame)) for frame in chunk], clip) for clip in [metric_clips[0], metric_clips[n + 1]]]
+
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                chunk_read = metric_read_chunk(0)
+                for chunk_start in range(0, metric_batch_missing.shape[0], metric_sequential_read_frames):
+                    chunk = metric_batch_missing[chunk_start:chunk_start + metric_sequential_read_frames]
+                    span = profile_begin("Metric decode", "metric", n=n, frames=int(chunk.shape[0]))
+                    chunk_reference, chunk_clip = [future.result() for future in chunk_read]
+                    profile_end(span)
+                    if chunk_start + metric_sequential_read_frames < metric_batch_missing.shape[0]:
+                        chunk_read = metric_read_chunk(chunk_start + metric_sequential_read_frames)
+                    span = profile_begin("Metric calculation", "metric", n=n, frames=int(chunk.shape[0]))
+                    for current_frame, frame in enumerate(metric_calculate(metric_stored_clip(metric_clips[0], chunk_reference), metric_stored_clip(metric_clips[n + 1], chunk_clip)).frames(backlog=48), start=chunk_start):
+                        print(f"\033[KFrame {current_frame} / Calculating metric for test encode {n:0>2} / {current_frame / (time() - start):.02f} fps", end="\r")
+                        metric_cache_store(n, metric_batch_missing[current_frame], frame)
+                    profile_end(span)
+        print(f"\033[KFrame {current_frame} / Metric calculation for test encode {n:0>2} complete / {current_frame / (time() - start):.02f} fps")
+        metric_cache_flush(n)
+
+    # This measures each of the test encodes running in `future` as soon as it's put into `finished`.
+    def metric_measure_pipelined(future, finished, count):
+        for _ in range(count):
+            while True:
+                try:
+                    n, _ = finished.get(timeout=1)
                     break
+                except Empty:
+                    if future.done():
+                        future.result()
+            metric_cache[n] = metric_open_cache(testing_crfs[n])
+            testing_done[n] = True
+            metric_clips[:] = metric_process([metric_reference] + [metric_load_encode(n_) for n_ in range(len(testing_crfs))])
+            metric_measure(n)
+        future.result()
+
+    if testing_pipelined:
+        metric_measure_pipelined(testing_future, testing_finished, len(testing_passes))
+    elif metric_batched:
+        for n in np.nonzero(testing_done)[0]:
+            metric_measure(n)
+
+    # Each scene is processed independently in `metric_scene_quantisers` and `metric_scene`, which can be run for multiple scenes concurrently with `--metric-workers`.
+    # Everything that's written to the output or printed is handled in scene order in the loops below.
+    @profile_function("Summarise metric", "scene", index="scene")
+    def metric_scene_quantisers(i, scene):
+        reports = []
+
+        frames = metric_batch_frames[metric_batch_begin[i]:metric_batch_begin[i + 1]]
+        # The spliced clips measure the first picked frame twice.
+        frames_ = np.concatenate((frames[:1], frames))
+
+        clips = None
+        printed = False
+        quantisers = np.full((len(testing_crfs),), np.nan, dtype=float)
+        for n in np.nonzero(testing_encoded[i])[0]:
+            if np.any(metric_cache_missing(n, frames)):
+                if clips is None:
+                    clips = []
+                    for metric_clip in metric_clips:
+                        clip = metric_clip[int(frames[0])]
+                        for frame in frames:
+                            clip += metric_clip[int(frame)]
+                        clips.append(clip)
+
+                for frame_number, frame in zip(frames_, metric_calculate(clips[0], clips[n + 1]).frames()):
+                    metric_cache_store(n, frame_number, frame)
+            scores = metric_cache_scores(n, frames_)
+            try:
+                quantisers[n] = metric_summarise(scores)
+            except UnreliableSummarisationError as e:
+                if not printed:
+                    reports.append(f"{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Unreliable summarisation / {str(e)}")
+                    printed = True
+                quantisers[n] = e.score
+
+        return quantisers, reports
+
+    # Models are fitted only to the test encodes done for the scene.
+    @profile_function("Model fit", "scene", index="scene")
+    def metric_scene_model(i, scene, quantisers, reports):
+        encoded = testing_encoded[i]
+        try:
+            return metric_model(testing_crfs[encoded], quantisers[encoded]), True
+        except UnreliableModelError as e:
+            if not np.all(metric_better_metric(quantisers[encoded], metric_target)):
+                reports.append(f"{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Unreliable model / {str(e)}")
+            return e.model, False
+
+    @profile_function("CRF search", "scene", index="scene")
+    def metric_scene_crf(i, scene, model, reports):
+        final_crf = None
+        # This is in fact iterating metric_iterate_crfs, which is constructed above below the Ding comment.
+        better = metric_better_metric(model(metric_iterate_crfs[:len(testing_crfs) + 1]), metric_target)
+        for n in range(len(testing_crfs) + 1):
+            if better[n]:
+                if n == len(testing_crfs):
+                    # This means even at final_max_crf, we are still higher than the target quality.
+                    # We will just use final_max_crf as final_crf. It shouldn't matter.
+                    final_crf = metric_iterate_crfs[n]
+                    break
+                else:
+                    # This means the point where predicted quality meets the target is in higher crf ranges.
+                    # We will skip this range and continue.
+                    continue
             else:
-                # The last item in the iteration is metric_iterate_crfs[n-1], and from outer loop we know that at that crf the predicted quality is higher than the target.
-                # The only case that this else clause will be reached is at n == 0, that even at metric_iterate_crfs[-1], or final_min_crf, the predicted quality is still below the target the target.
-                print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Potential low quality scene / The predicted quality at `final_min_crf` is {value:.3f}, which is worse than `metric_target` at {metric_target:.3f}")
-                printing = True
-                final_crf = metric_iterate_crfs[n-1]
-            
-            if final_crf is not None:
-                break
-    else:
-        assert False, "This indicates a bug in the original code. Please report this to the repository including this error message in full."
+                # Because we know from previous iteration that at metric_iterate_crfs[n-1], the predicted quality is higher than the target,
+                # and now at metric_iterate_crfs[n], the prediceted quality is lower than the target,
+                # this means the point where predicted quality meets the target is within this range between metric_iterate_crfs[n] and metric_iterate_crfs[n-1].
+                # The only exception is when n == 0, while will be dealt with later.
+                final_crf = metric_solve_crf(model, metric_iterate_crfs[n], metric_iterate_crfs[n-1])
+                if final_crf is None:
+                    # The last step checked is metric_iterate_crfs[n-1], and from outer loop we know that at that crf the predicted quality is higher than the target.
+                    # The only case that this will be reached is at n == 0, that even at metric_iterate_crfs[-1], or final_min_crf, the predicted quality is still below the target the target.
+                    reports.append(f"{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Potential low quality scene / The predicted quality at `final_min_crf` is {model(metric_iterate_crfs[n-1]):.3f}, which is worse than `metric_target` at {metric_target:.3f}")
+                    final_crf = metric_iterate_crfs[n-1]
+
+                if final_crf is not None:
+                    break
+        else:
+            assert False, "This indicates a bug in the original code. Please report this to the repository including this error message in full."
 
-    if character_enable:
-        clip = character_clip[scene["start_frame"]]
-        for fter in range(1, (scene["end_frame"] - scene["start_frame"]) // 8 + 1):
-            clip += (character_clip[scene["start_frame"] + fter * 8])
-
-        roi_map = []
-        uniform_offset = character_sigma // 1.5
-        uniform_nonboosting_offset = 0
-        character_key_multiplier = 1.00
-        character_32_multiplier = 0.80
-        character_16_multiplier = 0.60
-        character_8_multiplier = 0.40
-        for fter, frame in enumerate(clip.frames(backlog=48)):
-            a = np.array(frame[0], dtype=np.float32).reshape((character_block_height, -1))
-            a = a[:, :character_block_width]
-            a = np.round(a * -7).reshape((1, -1))
-
-            if fter == 0:
-                a = np.round(a * (character_sigma / 1.75 * character_key_multiplier) + uniform_offset)
-                roi_map.append([0, a])
-                roi_map.append([1, np.full_like(a, uniform_nonboosting_offset, dtype=np.float32)])
-            elif fter % 4 == 0:
-                a = np.round(a * (character_sigma / 1.75 * character_32_multiplier) + uniform_offset)
-                roi_map.append([fter * 8, a])
-                roi_map.append([fter * 8 + 1, np.full_like(a, uniform_nonboosting_offset, dtype=np.float32)])
-            elif fter % 2 == 0:
-                a = np.round(a * (character_sigma / 1.75 * character_16_multiplier) + uniform_offset)
-                roi_map.append([fter * 8, a])
-                roi_map.append([fter * 8 + 1, np.full_like(a, uniform_nonboosting_offset, dtype=np.float32)])
-            else:
-                a = np.round(a * (character_sigma / 1.75 * character_8_multiplier) + uniform_offset)
-                roi_map.append([fter * 8, a])
-                roi_map.append([fter * 8 + 1, np.full_like(a, uniform_nonboosting_offset, dtype=np.float32)])
-
-        needed_offset = 0
-        crf_offset = 0
-        for line in roi_map:
-            if (offset := np.max(line[1])) < 0.01:
-                needed_offset = np.max([needed_offset, -offset])
-        if needed_offset > 0.01:
+        return final_crf
+
+    @profile_function("Boost calculation", "scene", index="scene")
+    def metric_scene(i, scene):
+        quantisers = metric_quantisers[i]
+        reports = list(metric_quantisers_reports[i])
+
+        model, _ = metric_scene_model(i, scene, quantisers, reports)
+
+        final_crf = metric_scene_crf(i, scene, model, reports)
+
+        if character_enable:
+            span = profile_begin("ROI map", "scene", scene=i)
+            clip = character_clip[scene["start_frame"]]
+            for fter in range(1, (scene["end_frame"] - scene["start_frame"]) // 8 + 1):
+                clip += (character_clip[scene["start_frame"] + fter * 8])
+
+            roi_map = []
+            uniform_offset = character_sigma // 1.5
+            uniform_nonboosting_offset = 0
+            character_key_multiplier = 1.00
+            character_32_multiplier = 0.80
+            character_16_multiplier = 0.60
+            character_8_multiplier = 0.40
+            for fter, frame in enumerate(clip.frames(backlog=48)):
+                a = np.array(frame[0], dtype=np.float32).reshape((character_block_height, -1))
+                a = a[:, :character_block_width]
+                a = np.round(a * -7).reshape((1, -1))
+
+                if fter == 0:
+                    a = np.round(a * (character_sigma / 1.75 * character_key_multiplier) + uniform_offset)
+                    roi_map.append([0, a])
+                    roi_map.append([1, np.full_like(a, uniform_nonboosting_offset, dtype=np.float32)])
+                elif fter % 4 == 0:
+                    a = np.round(a * (character_sigma / 1.75 * character_32_multiplier) + uniform_offset)
+                    roi_map.append([fter * 8, a])
+                    roi_map.append([fter * 8 + 1, np.full_like(a, uniform_nonboosting_offset, dtype=np.float32)])
+                elif fter % 2 == 0:
+                    a = np.round(a * (character_sigma / 1.75 * character_16_multiplier) + uniform_offset)
+                    roi_map.append([fter * 8, a])
+                    roi_map.append([fter * 8 + 1, np.full_like(a, uniform_nonboosting_offset, dtype=np.float32)])
+                else:
+                    a = np.round(a * (character_sigma / 1.75 * character_8_multiplier) + uniform_offset)
+                    roi_map.append([fter * 8, a])
+                    roi_map.append([fter * 8 + 1, np.full_like(a, uniform_nonboosting_offset, dtype=np.float32)])
+
+            needed_offset = 0
+            crf_offset = 0
             for line in roi_map:
-                line[1] += needed_offset
-            crf_offset = 0.25 * -needed_offset
-               
-        roi_map_file = roi_maps_dir / f"roi-map-{metric_scene_rjust(i)}.txt"
-        with roi_map_file.open("w") as roi_map_f:
-            for line in roi_map:
-                roi_map_f.write(f"{line[0]} ")
-                np.savetxt(roi_map_f, line[1], fmt="%d")
+                if (offset := np.max(line[1])) < 0.01:
+                    needed_offset = np.max([needed_offset, -offset])
+            if needed_offset > 0.01:
+                for line in roi_map:
+                    line[1] += needed_offset
+                crf_offset = 0.25 * -needed_offset
+
+            roi_map_file = roi_maps_dir / f"roi-map-{metric_scene_rjust(i)}.txt"
+            with roi_map_file.open("w") as roi_map_f:
+                for line in roi_map:
+                    roi_map_f.write(f"{line[0]} ")
+                    np.savetxt(roi_map_f, line[1], fmt="%d")
+            profile_end(span)
+
+        if character_enable:
+            final_crf = final_crf + crf_offset
+        else:
+            roi_map_file = None
 
-    if character_enable:
-        roi_parameters_string = f"--roi-map-file '{roi_map_file}'"
-        roi_parameters_array = ["--roi-map-file", str(roi_map_file)]
-    else:
-        roi_parameters_string = ""
-        roi_parameters_array = []
+        return final_crf, roi_map_file, reports
 
-    if character_enable:
-        final_crf = final_crf + crf_offset
+    if metric_workers > 1:
+        metric_executor = ThreadPoolExecutor(max_workers=metric_workers)
+        metric_map = metric_executor.map
+    else:
+        metric_map = map
+
+    if testing_progressive:
+        # The scenes are stored as [start_frame, end_frame] together with the indices of the scenes not settled, since the scenes may be created
+        # again with `--resume`. If anything changed, the progressive test encodes from before are for different scenes and are removed.
+        testing_progressive_config = {"crfs": testing_crfs.tolist(), "progressive_crfs": testing_progressive_crfs.tolist(),
+                                      "ranges": [[scene["start_frame"], scene["end_frame"]] for scene in scenes["scenes"]]}
+        testing_progressive_stored = json.loads(testing_progressive_file.read_text()) if testing_resume and testing_progressive_file.exists() else {}
+        if {key: value for key, value in testing_progressive_stored.items() if key != "scenes"} == testing_progressive_config:
+            testing_progressive_scenes = testing_progressive_stored["scenes"]
+        else:
+            if testing_progressive_file.exists():
+                testing_progressive_file.unlink()
+                for n in range(len(testing_crfs)):
+                    temp_dir.joinpath(f"test-encode-{n:0>2}-progressive.mkv").unlink(missing_ok=True)
+                    shutil.rmtree(temp_dir.joinpath(f"test-encode-{n:0>2}-progressive.tmp"), ignore_errors=True)
+
+            metric_quantisers = np.empty((len(scenes["scenes"]), len(testing_crfs)), dtype=float)
+            start = time() - 0.000001
+            for i, (scene, (quantisers, _)) in enumerate(zip(scenes["scenes"], metric_map(metric_scene_quantisers, range(len(scenes["scenes"])), scenes["scenes"]))):
+                print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Summarising metric for coarse test encodes / {i / (time() - start):.02f} scenes per second", end="\r")
+                metric_quantisers[i] = quantisers
+
+            def testing_progressive_settled(i, scene):
+                model, reliable = metric_scene_model(i, scene, metric_quantisers[i], [])
+                final_crf = metric_scene_crf(i, scene, model, [])
+                return reliable and testing_crfs[np.argmin(np.abs(testing_crfs - final_crf))] in testing_progressive_crfs
+            testing_progressive_scenes = [i for i, settled in enumerate(metric_map(testing_progressive_settled, range(len(scenes["scenes"])), scenes["scenes"])) if not settled]
+
+            with testing_progressive_file.open("w") as progressive_f:
+                json.dump(testing_progressive_config | {"scenes": testing_progressive_scenes}, progressive_f)
+        print(f"\033[K{len(testing_progressive_scenes)} of {len(scenes["scenes"])} scenes are not settled after coarse test encodes")
+
+        if testing_progressive_scenes:
+            testing_write_input(testing_progressive_input_file, testing_progressive_scenes_file,
+                                [[scenes["scenes"][i]["start_frame"], scenes["scenes"][i]["end_frame"]] for i in testing_progressive_scenes])
+            testing_progressive_passes = []
+            for n, crf in enumerate(testing_crfs):
+                if not np.any(testing_encoded[:, n]):
+                    testing_encoded[testing_progressive_scenes, n] = True
+                    testing_partial[n] = True
+                    testing_progressive_passes.append((n, crf, testing_progressive_input_file, testing_progressive_scenes_file, f"test-encode-{n:0>2}-progressive"))
+            if testing_pipelined:
+                metric_measure_pipelined(testing_executor.submit(testing_encode, testing_progressive_passes, testing_finished), testing_finished, len(testing_progressive_passes))
+            else:
+                # The passes reused from `--resume` are not returned from `testing_encode`, but they need their store opened all the same.
+                testing_encode(testing_progressive_passes)
+                for n, *_ in testing_progressive_passes:
+                    metric_cache[n] = metric_open_cache(testing_crfs[n])
+                testing_done[[pass_[0] for pass_ in testing_progressive_passes]] = True
+
+                metric_clips = metric_process([metric_reference] + [metric_load_encode(n) for n in range(len(testing_crfs))])
+                if metric_batched:
+                    for n in np.nonzero(testing_partial)[0]:
+                        metric_measure(n)
+
+    if testing_pipelined:
+        testing_executor.shutdown()
+
+    metric_quantisers = np.empty((len(scenes["scenes"]), len(testing_crfs)), dtype=float)
+    metric_quantisers_reports = []
+    start = time() - 0.000001
+    for i, (scene, (quantisers, reports)) in enumerate(zip(scenes["scenes"], metric_map(metric_scene_quantisers, range(len(scenes["scenes"])), scenes["scenes"]))):
+        print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Summarising metric / {i / (time() - start):.02f} scenes per second", end="\r")
+        metric_quantisers[i] = quantisers
+        metric_quantisers_reports.append(reports)
+
+    metric_results = metric_map(metric_scene, range(len(scenes["scenes"])), scenes["scenes"])
+
+    start = time() - 0.000001
+    for i, (scene, (final_crf, roi_map_file, reports)) in enumerate(zip(scenes["scenes"], metric_results)):
+        print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Calculating boost / {i / (time() - start):.02f} scenes per second", end="\r")
+        for report in reports:
+            print(f"\033[K{report}")
+
+        if character_enable:
+            roi_parameters_string = f"--roi-map-file '{roi_map_file}'"
+            roi_parameters_array = ["--roi-map-file", str(roi_map_file)]
+        else:
+            roi_parameters_string = ""
+            roi_parameters_array = []
 
-    final_crf_ = final_dynamic_crf(final_crf)
-    # If you want to use a different encoder than SVT-AV1 derived ones, modify here. This is not tested and may have additional issues.
-    final_crf_ = round(final_crf_ / 0.25) * 0.25
+        final_crf_ = final_dynamic_crf(final_crf)
+        # If you want to use a different encoder than SVT-AV1 derived ones, modify here. This is not tested and may have additional issues.
+        final_crf_ = round(final_crf_ / 0.25) * 0.25
+
+        if reports or metric_verbose or final_crf_ < metric_reporting_crf:
+            print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / OK / Final crf: {final_crf_:.2f}")
+
+        if zones_file:
+            # If you want to use a different encoder than SVT-AV1 derived ones, modify here. This is not tested and may have additional issues.
+            zones_f.write(f"{scene["start_frame"]} {scene["end_frame"]} svt-av1 {"reset" if final_parameters_reset else ""} --crf {final_crf_:.2f} {final_dynamic_parameters(final_crf)} {final_parameters} {roi_parameters_string}\n")
+
+        if scenes_file:
+            scene["zone_overrides"] = {
+                "encoder": "svt_av1",
+                "passes": 1,
+                "video_params": ["--crf", f"{final_crf_:.2f}" ] + final_dynamic_parameters(final_crf).split() + final_parameters.split() + roi_parameters_array,
+                "photon_noise": photon_noise,
+                "extra_splits_len": scene_detection_extra_split,
+                "min_scene_len": scene_detection_min_scene_len
+            }
+            if chroma_noise_available:
+                scene["zone_overrides"]["chroma_noise"] = chroma_noise
+
+    if metric_workers > 1:
+        metric_executor.shutdown()
 
-    if printing or metric_verbose or final_crf_ < metric_reporting_crf:
-        print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / OK / Final crf: {final_crf_:.2f}")
+    for n in range(len(testing_crfs)):
+        metric_cache_flush(n)
 
     if zones_file:
-        # If you want to use a different encoder than SVT-AV1 derived ones, modify here. This is not tested and may have additional issues.
-        zones_f.write(f"{scene["start_frame"]} {scene["end_frame"]} svt-av1 {"reset" if final_parameters_reset else ""} --crf {final_crf_:.2f} {final_dynamic_parameters(final_crf)} {final_parameters} {roi_parameters_string}\n")
+        zones_f.close()
 
     if scenes_file:
-        scene["zone_overrides"] = {
-            "encoder": "svt_av1",
-            "passes": 1,
-            "video_params": ["--crf", f"{final_crf_:.2f}" ] + final_dynamic_parameters(final_crf).split() + final_parameters.split() + roi_parameters_array,
-            "photon_noise": photon_noise,
-            "extra_splits_len": scene_detection_extra_split,
-            "min_scene_len": scene_detection_min_scene_len
-        }
-        if chroma_noise_available:
-            scene["zone_overrides"]["chroma_noise"] = chroma_noise
+        with scenes_file.open("w") as scenes_f:
+            json.dump(scenes, scenes_f)
+    print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Boost calculation complete / {i / (time() - start):.02f} scenes per second")
+
+    source_close(input_file)
+    for n in range(len(testing_crfs)):
+        for encode_file in [temp_dir.joinpath(f"test-encode-{n:0>2}.mkv"), temp_dir.joinpath(f"test-encode-{n:0>2}-progressive.mkv")]:
+            if encode_file.exists():
+                source_close(encode_file)
+    yield "metric"
 
-if zones_file:
-    zones_f.close()
 
-if scenes_file:
-    with scenes_file.open("w") as scenes_f:
-        json.dump(scenes, scenes_f)
-print(f"\033[K{metric_scene_frame_print(i, scene["start_frame"], scene["end_frame"])} / Boost calculation complete / {i / (time() - start):.02f} scenes per second")
+# This is the importable interface of Progression Boost. The arguments are the same as the commandline arguments, while everything else is
+# taken from the config above. `step` runs the next stage and returns the name of the stage, or None if all stages are finished, and `run`
+# runs all remaining stages. For example, to run Progression Boost on a few episodes in one process:
+#
+#     import importlib.util
+#     spec = importlib.util.spec_from_file_location("progression_boost", "Progression-Boost.py")
+#     progression_boost = importlib.util.module_from_spec(spec)
+#     spec.loader.exec_module(progression_boost)
+#     for episode in ["01", "02", "03"]:
+#         progression_boost.ProgressionBoost(Path(f"{episode}.mkv"), output_scenes=Path(f"{episode}.scenes.json")).run()
+#
+# The config is not passed to `ProgressionBoost`. Every run reads the config from the module it's created from, at the time each stage
+# runs, so all runs from the same module share the same config. To change the config, set it on the module before creating the runs, such
+# as `progression_boost.metric_target = 75.000`, and don't change it while any of the runs is not finished. For runs with different configs
+# in the same process, load the file once for every config by repeating the `spec_from_file_location` lines above, and set the config on
+# each of the modules. Runs from different modules can be put into the same `progression_boost_batch`, but each module keeps its own
+# count of the test encodes running, so the `--workers` in `testing_av1an_parameters` are only shared among runs from the same module.
+class ProgressionBoost:
+    stages = ["scene detection", "testing", "metric"]
+
+    def __init__(self, input_file, encode_input_file=None, output_zones=None, output_scenes=None, output_roi_maps=None, temp_dir=None,
+                 resume=False, verbose=False, metric_workers=1):
+        assert output_zones or output_scenes, "At least one of `output_zones` and `output_scenes` is required."
+        if temp_dir is None:
+            temp_dir = (output_zones if output_zones else output_scenes).with_suffix(".boost.tmp")
+        self.input_file = input_file
+        self.encode_input_file = encode_input_file if encode_input_file is not None else input_file
+        self.output_zones = output_zones
+        self.output_scenes = output_scenes
+        self.output_roi_maps = output_roi_maps
+        self.temp_dir = temp_dir
+        self.stage = None
+        self._testing_stop = threading.Event()
+        self._stages = progression_boost_run(self.input_file, self.encode_input_file, output_zones, output_scenes, output_roi_maps, temp_dir,
+                                             resume, verbose, metric_workers, self._testing_stop)
+
+    def step(self):
+        # If a stage fails, the test encodes still running in the background for this run are stopped, instead of running all the
+        # remaining test encodes before the process can exit.
+        try:
+            self.stage = next(self._stages, None)
+        except BaseException:
+            self._testing_stop.set()
+            raise
+        return self.stage
+
+    def run(self):
+        while self.step() is not None:
+            pass
+
+# This runs multiple `ProgressionBoost`s as a batch. Scene detection, test encodes and metric calculation each run in a lane of their own,
+# and the runs are passed from one lane to the next in order. While one run is test encoding, the next run can be detecting scenes and the
+# previous run can be calculating metric. Each lane works on one run at a time, so scene detection and metric calculation use the same
+# resources as when running a single episode, and the test encodes from all runs share the `--workers` in `testing_av1an_parameters`.
+# At most `batch_runs` runs are started and not yet finished at the same time. If a run fails, no new runs are started, while the runs
+# already started are finished before the error is raised.
+# If a lane itself fails, the lanes after it still stop once the lanes before them are finished, and the test encodes of the runs left
+# unfinished are stopped.
+batch_runs = 3
+def progression_boost_batch(pipelines):
+    pipelines = list(pipelines)
+    errors = []
+    started = threading.Semaphore(batch_runs)
+
+    def lane(stage, take, give):
+        try:
+            for pipeline in take:
+                if stage == ProgressionBoost.stages[0]:
+                    started.acquire()
+                    if errors:
+                        started.release()
+                        continue
+                print(f"\033[K{pipeline.input_file.name} / Starting {stage}")
+                try:
+                    assert pipeline.step() == stage, "This indicates a bug in the original code. Please report this to the repository including this error message in full."
+                except BaseException as e:
+                    errors.append(e)
+                    started.release()
+                    continue
+                if give is not None:
+                    give.put(pipeline)
+                else:
+                    started.release()
+        except BaseException as e:
+            errors.append(e)
+            # The runs taken by this lane are never released, so the scene detection lane is let through to see the error instead.
+            started.release(batch_runs)
+            raise
+        finally:
+            if give is not None:
+                give.put(None)
+
+    detected = Queue()
+    tested = Queue()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        lanes = [executor.submit(lane, ProgressionBoost.stages[0], pipelines, detected),
+                 executor.submit(lane, ProgressionBoost.stages[1], iter(detected.get, None), tested),
+                 executor.submit(lane, ProgressionBoost.stages[2], iter(tested.get, None), None)]
+    if errors:
+        for pipeline in pipelines:
+            if pipeline.stage != ProgressionBoost.stages[-1]:
+                pipeline._testing_stop.set()
+    for future in lanes:
+        future.result()
+    if errors:
+        raise errors[0]
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if not args.output_zones and not args.output_scenes:
+        parser.print_usage()
+        print("Progression Boost: error: at least one of the following arguments is required: -o/--output-zones, --output-scenes")
+        raise SystemExit(2)
+    if character_enable and not args.output_roi_maps:
+        parser.print_usage()
+        print("Progression Boost: error: the following arguments is required: --output-roi-maps")
+        raise SystemExit(2)
+    for flag, values in [("--encode-input", args.encode_input), ("-o/--output-zones", args.output_zones), ("--output-scenes", args.output_scenes),
+                         ("--output-roi-maps", args.output_roi_maps), ("--temp", args.temp)]:
+        if values is not None and len(values) != len(args.input):
+            parser.print_usage()
+            print(f"Progression Boost: error: argument {flag} needs to be specified once for every -i/--input")
+            raise SystemExit(2)
+
+    argument = lambda values, i: values[i] if values is not None else None
+    pipelines = [ProgressionBoost(input_file, encode_input_file=argument(args.encode_input, i), output_zones=argument(args.output_zones, i),
+                                  output_scenes=argument(args.output_scenes, i), output_roi_maps=argument(args.output_roi_maps, i), temp_dir=argument(args.temp, i),
+                                  resume=args.resume, verbose=args.verbose, metric_workers=args.metric_workers)
+                 for i, input_file in enumerate(args.input)]
+    # In a batch, BestSource indexes and the profile are kept in the temporary folder of the first episode.
+    source_index_dir = pipelines[0].temp_dir.joinpath("source-index")
+    if args.profile:
+        profile_enable = True
+        atexit.register(profile_write, pipelines[0].temp_dir.joinpath("profile.trace.json"))
+    if len(pipelines) == 1:
+        pipelines[0].run()
+    else:
+        progression_boost_batch(pipelines)
@@ -29,6 +29,7 @@
 import argparse
 from itertools import islice
 import json
+import math
 import numpy as np
 from pathlib import Path
 from time import time
@@ -40,9 +41,9 @@ parser.add_argument("-h", "--help", action="store_true", help="Display help and
 parser.add_argument("-i", "--input", type=Path, help="Source video file")
 parser.add_argument("--input-colour-range", choices=["limited", "full"], default="limited", help="The colour range for the source video file")
 parser.add_argument("-m", "--method", choices=["wwxd", "wwxd_scxvid"], default="wwxd_scxvid", help="The method for scene detection. Using both WWXD and Scxvid is more reliable (Default), while WWXD alone is significantly faster")
-parser.add_argument("--extra-split", default=264, help="Maximum length for a scene (Default: 264)")
-parser.add_argument("--min-scene-len", default=12, help="Minimum length for a scene (Default: 12). Set this to match the length of the shortest cut in the source")
-parser.add_argument("--target-split", default=60, help="Target length for a scene (Default: 60). More explained below")
+parser.add_argument("--extra-split", type=int, default=264, help="Maximum length for a scene (Default: 264)")
+parser.add_argument("--min-scene-len", type=int, default=12, help="Minimum length for a scene (Default: 12). Set this to match the length of the shortest cut in the source")
+parser.add_argument("--target-split", type=int, default=60, help="Target length for a scene (Default: 60). More explained below")
 parser.add_argument("-o", "--output-zones", type=Path, help="Output zones file for encoding")
 parser.add_argument("--output-scenes", type=Path, help="Output scenes file for encoding")
 args = parser.parse_args()
@@ -107,75 +108,90 @@ if True:
         diffs = np.empty((scene_detection_clip.num_frames,), dtype=float)
         diffs[0] = 1.0
         luma_scenecut_prev = True
-        def scene_detection_split_scene(great_diffs, diffs, start_frame, end_frame):
+        # `scene_detection_split_scene` repeatedly looks for the frame with the highest diff among the frames satisfying a set of conditions.
+        # Each set of conditions is one or more ranges of frames, and the highest diff in a range is looked up from a sparse table in constant
+        # time. Ties are broken towards the later frame.
+        def scene_detection_build_argmax(diffs):
+            argmax_table = [np.arange(diffs.shape[0])]
+            width = 1
+            while width * 2 <= diffs.shape[0]:
+                left = argmax_table[-1][:-width]
+                right = argmax_table[-1][width:]
+                argmax_table.append(np.where(diffs[right] >= diffs[left], right, left))
+                width *= 2
+            return argmax_table
+
+        def scene_detection_argmax(diffs, ranges):
+            best = None
+            for low, high in ranges:
+                if low > high:
+                    continue
+                level = (high - low + 1).bit_length() - 1
+                left = scene_detection_argmax_table[level][low]
+                right = scene_detection_argmax_table[level][high - (1 << level) + 1]
+                current_frame = int(right if diffs[right] >= diffs[left] else left)
+                if best is None or diffs[current_frame] > diffs[best] or (diffs[current_frame] == diffs[best] and current_frame > best):
+                    best = current_frame
+            return best
+
+        def scene_detection_split_scene(diffs, start_frame, end_frame):
             print(f"Frame [{scene_detection_rjust(start_frame)}:{scene_detection_rjust(end_frame)}] / Creating scenes", end="\r")
 
             if end_frame - start_frame <= scene_detection_target_split or \
                end_frame - start_frame < 2 * scene_detection_min_scene_len:
                 return [start_frame]
 
-            great_diffs_sort = np.argsort(great_diffs)[::-1]
+            # Both sides of the split need to be at least `scene_detection_min_scene_len`
+            lowest = start_frame + scene_detection_min_scene_len
+            highest = min(end_frame - scene_detection_min_scene_len, diffs.shape[0] - 1)
+            # One of the sides of the split is at most `scene_detection_target_split`
+            target_ranges = [(lowest, min(highest, start_frame + scene_detection_target_split)),
+                             (max(lowest, end_frame - scene_detection_target_split), highest)]
+            # The split doesn't increase the number of `scene_detection_extra_split` long scenes needed beyond `limit`.
+            # `current_frame - start_frame` in `((j - 1) * scene_detection_extra_split, j * scene_detection_extra_split]` uses `j` scenes, and
+            # `end_frame - current_frame` is allowed `limit - j` scenes.
+            extra_split_ranges = lambda limit: [(max(lowest, start_frame + (j - 1) * scene_detection_extra_split + 1, end_frame - (limit - j) * scene_detection_extra_split),
+                                                 min(highest, start_frame + j * scene_detection_extra_split))
+                                                for j in range(1, math.ceil((end_frame - start_frame) / scene_detection_extra_split) + 1)]
 
             if end_frame - start_frame <= 2 * scene_detection_target_split:
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        break
-                    if current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len and \
-                       current_frame - start_frame <= scene_detection_target_split and end_frame - current_frame <= scene_detection_target_split:
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
+                current_frame = scene_detection_argmax(diffs, [(max(lowest, end_frame - scene_detection_target_split), min(highest, start_frame + scene_detection_target_split))])
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
 
             if end_frame - start_frame <= scene_detection_extra_split:
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        break
-                    if (current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len) and \
-                       (current_frame - start_frame <= scene_detection_target_split or end_frame - current_frame <= scene_detection_target_split):
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
-
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        return [start_frame]
-                    if current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len:
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
+                current_frame = scene_detection_argmax(diffs, target_ranges)
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+
+                current_frame = scene_detection_argmax(diffs, [(lowest, highest)])
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+                return [start_frame]
 
             else: # end_frame - start_frame > scene_detection_extra_split
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.12:
-                        break
-                    if (current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len) and \
-                       np.ceil((current_frame - start_frame) / scene_detection_extra_split).astype(int) + \
-                       np.ceil((end_frame - current_frame) / scene_detection_extra_split).astype(int) <= \
-                       np.ceil((end_frame - start_frame) / scene_detection_extra_split + 0.15).astype(int):
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
-                               
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        break
-                    if (current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len) and \
-                       (current_frame - start_frame <= scene_detection_target_split or end_frame - current_frame <= scene_detection_target_split):
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
-
-                for current_frame in great_diffs_sort:
-                    if great_diffs[current_frame] < 1.16:
-                        break
-                    if current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len:
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
-
-                diffs_sort = np.argsort(diffs, stable=True)[::-1]
-
-                for current_frame in diffs_sort:
-                    if (current_frame - start_frame >= scene_detection_min_scene_len and end_frame - current_frame >= scene_detection_min_scene_len) and \
-                       np.ceil((current_frame - start_frame) / scene_detection_extra_split).astype(int) + \
-                       np.ceil((end_frame - current_frame) / scene_detection_extra_split).astype(int) <= \
-                       np.ceil((end_frame - start_frame) / scene_detection_extra_split).astype(int):
-                        return scene_detection_split_scene(great_diffs, diffs, start_frame, current_frame) + \
-                               scene_detection_split_scene(great_diffs, diffs, current_frame, end_frame)
+                current_frame = scene_detection_argmax(diffs, extra_split_ranges(math.ceil((end_frame - start_frame) / scene_detection_extra_split + 0.15)))
+                if current_frame is not None and diffs[current_frame] >= 1.12:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+
+                current_frame = scene_detection_argmax(diffs, target_ranges)
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+
+                current_frame = scene_detection_argmax(diffs, [(lowest, highest)])
+                if current_frame is not None and diffs[current_frame] >= 1.16:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
+
+                current_frame = scene_detection_argmax(diffs, extra_split_ranges(math.ceil((end_frame - start_frame) / scene_detection_extra_split)))
+                if current_frame is not None:
+                    return scene_detection_split_scene(diffs, start_frame, current_frame) + \
+                           scene_detection_split_scene(diffs, current_frame, end_frame)
 
             assert False, "This indicates a bug in the original code. Please report this to the repository including this error message in full."
 
@@ -204,9 +220,8 @@ if True:
             luma_scenecut_prev = luma_scenecut
         print(f"Frame {current_frame} / Scene detection complete / {current_frame / (time() - start):.02f} fps")
 
-        great_diffs = diffs.copy()
-        great_diffs[great_diffs < 1.0] = 0
-        start_frames = scene_detection_split_scene(great_diffs, diffs, 0, len(diffs)) + [scene_detection_clip.num_frames]
+        scene_detection_argmax_table = scene_detection_build_argmax(diffs)
+        start_frames = scene_detection_split_scene(diffs, 0, len(diffs)) + [scene_detection_clip.num_frames]
         for i in range(len(start_frames) - 1):
             scenes["scenes"].append({"start_frame": int(start_frames[i]), "end_frame": int(start_frames[i + 1]), "zone_overrides": None})
         print(f"Frame [{scene_detection_rjust(start_frames[i])}:{scene_detection_rjust(start_frames[i + 1])}] / Scene creation complete")